@@ -0,0 +1,47 @@
+'''
+This script replaces the separate time and station indexes on every
+ts_param_ table with a single (station, time) index, which is what
+Grafana's "station X between t1 and t2" queries need. An optional last
+argument picks a different index mode, for example covering.
+
+Each table is converted in its own transaction, so an interrupted run
+leaves every table either converted or untouched. A transaction holds
+the write lock for as long as its table takes, so stop the bridge first.
+'''
+
+import sys
+from collections import Counter
+
+import vlbimon_bridge.utils
+import vlbimon_bridge.migrate as migrate
+import vlbimon_bridge.sqlite as sqlite
+
+
+index = 'composite'
+if len(sys.argv) == 4:
+    index = sys.argv.pop()
+if index not in sqlite.index_modes:
+    print('unknown index mode', index, 'choose one of', *sorted(sqlite.index_modes))
+    exit(1)
+
+verb, db = migrate.parse_argv(sys.argv)
+vlbimon_bridge.utils.checkout_db(db, mode='r')
+
+modes = migrate.get_index_modes(db)
+for mode, count in sorted(Counter(str(m) for m in modes.values()).items()):
+    print(count, 'tables with index mode', mode)
+
+todo = [table for table, mode in sorted(modes.items()) if mode != index]
+
+if verb == 'check':
+    exit(0)
+if not todo:
+    print('not changing anything')
+    exit(1)
+
+print('fixing')
+vlbimon_bridge.utils.checkout_db(db, mode='w')
+
+migrate.do_convert_indexes(db, index, todo)
+
+print('done')
@@ -0,0 +1,50 @@
+'''
+This script rebuilds every ts_param_ table as a WITHOUT ROWID table
+clustered on (station, time, seq), which drops the secondary indexes.
+Run VACUUM afterwards to give the freed pages back to the filesystem.
+An optional last argument of rowid converts back, with composite indexes,
+and points converts to the single points table with ts_param_ views.
+
+Each table is converted in its own transaction, so an interrupted run
+leaves every table either converted or untouched. A transaction holds
+the write lock for as long as its table takes, so stop the bridge first.
+'''
+
+import sys
+from collections import Counter
+
+import vlbimon_bridge.utils
+import vlbimon_bridge.migrate as migrate
+
+
+layout = 'clustered'
+if len(sys.argv) == 4:
+    layout = sys.argv.pop()
+if layout not in ('rowid', 'clustered', 'points'):
+    print('unknown layout', layout)
+    exit(1)
+
+verb, db = migrate.parse_argv(sys.argv)
+vlbimon_bridge.utils.checkout_db(db, mode='r')
+
+layouts = migrate.get_layouts(db)
+for lay, count in sorted(Counter(layouts.values()).items()):
+    print(count, 'tables with layout', lay)
+
+todo = [table for table, lay in sorted(layouts.items()) if lay != layout]
+
+if verb == 'check':
+    exit(0)
+if layout != 'points' and 'points' in layouts.values():
+    print('converting out of the points layout is not supported')
+    exit(1)
+if not todo:
+    print('not changing anything')
+    exit(1)
+
+print('fixing')
+vlbimon_bridge.utils.checkout_db(db, mode='w')
+
+migrate.do_convert_layout(db, todo, layout)
+
+print('done, consider running VACUUM')
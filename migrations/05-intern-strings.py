@@ -0,0 +1,33 @@
+'''
+This script dictionary-encodes the string values of a points layout
+database (see initdb --layout points --intern): each distinct string is
+stored once in the strings table, and the ts_param_ views turn the ids
+back into text. Run VACUUM afterwards.
+'''
+
+import sys
+
+import vlbimon_bridge.utils
+import vlbimon_bridge.migrate as migrate
+
+
+verb, db = migrate.parse_argv(sys.argv)
+vlbimon_bridge.utils.checkout_db(db, mode='r')
+
+layouts = migrate.get_layouts(db)
+plain = len([lay for lay in layouts.values() if lay == 'points'])
+interned = len([lay for lay in layouts.values() if lay == 'points_strings'])
+print(plain, 'params in the points layout,', interned, 'with interned strings')
+
+if verb == 'check':
+    exit(0)
+if not plain and not interned:
+    print('not a points layout database, see migrations/04-convert-clustered.py')
+    exit(1)
+
+print('fixing')
+vlbimon_bridge.utils.checkout_db(db, mode='w')
+
+migrate.do_intern_strings(db)
+
+print('done, consider running VACUUM')
@@ -0,0 +1,33 @@
+'''
+This script adds the bridge_eventState table, which lets the bridge
+remember which events it has already written across restarts
+'''
+
+import sys
+
+import vlbimon_bridge.utils
+import vlbimon_bridge.migrate as migrate
+import vlbimon_bridge.sqlite as sqlite
+
+
+verb, db = migrate.parse_argv(sys.argv)
+
+# checks file and directory permissions
+vlbimon_bridge.utils.checkout_db(db, mode='r')
+
+names = migrate.get_tables(db)
+present = 'bridge_eventState' in names
+print('bridge_eventState is', 'present' if present else 'not present')
+
+if verb == 'check':
+    exit(0)
+if present:
+    print('not changing anything')
+    exit(1)
+
+print('fixing')
+vlbimon_bridge.utils.checkout_db(db, mode='w')
+
+migrate.do_stuff(db, [sqlite.eventState_sql])
+
+print('done')
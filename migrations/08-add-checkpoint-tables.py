@@ -0,0 +1,40 @@
+'''
+This script adds the tables recording the bridge's WAL checkpoints, for bridge --checkpoint
+'''
+
+import sys
+
+import vlbimon_bridge.utils
+import vlbimon_bridge.migrate as migrate
+
+
+verb, db = migrate.parse_argv(sys.argv)
+
+# checks file and directory permissions
+vlbimon_bridge.utils.checkout_db(db, mode='r')
+
+names = migrate.get_tables(db)
+
+table_renames = {}
+new_real_tables = [
+    'bridge_checkpointTime',  # seconds
+]
+new_integer_tables = [
+    'bridge_walSize',  # bytes
+]
+
+old_count, new_count = migrate.check_old_new(names, table_renames, new_real_tables + new_integer_tables)
+
+if verb == 'check':
+    exit(0)
+if new_count > 0:
+    print('not changing anything')
+    exit(1)
+
+print('fixing')
+vlbimon_bridge.utils.checkout_db(db, mode='w')
+
+migrate.do_new_tables(db, new_real_tables, vlbi_type='REAL')
+migrate.do_new_tables(db, new_integer_tables, vlbi_type='INTEGER')
+
+print('done')
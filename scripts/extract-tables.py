@@ -1,5 +1,5 @@
+import os
 import sys
-from collections import defaultdict
 import datetime
 import csv
 
@@ -28,26 +28,24 @@ for name in names:
 
     query = 'SELECT time, station, value from {} ORDER BY time'
     res = cur.execute(query.format(name))
-    rows = res.fetchall()
-
-    if not res:
-        print('not res')
-        continue
-
-    if not rows:
-        continue
-
-    new = []
-    for row in rows:
-        # this is a list
-        t = int(row[0])
-        ts = datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc).strftime(TIMESTAMP)
-        new.append((t, ts, *row[1:]))
-    rows = new
 
     fname = name.replace('ts_param_', '', 1)
 
+    # stream the rows, a whole table might not fit in memory.
+    # vlbimon_bridge export does this too, with more options
+    count = 0
     with open(fname + '.csv', 'w', newline='') as fd:
         csv_writer = csv.writer(fd)
-        csv_writer.writerow([x[0] for x in res.description])
-        csv_writer.writerows(rows)
+        csv_writer.writerow(['time', 'timestamp', 'station', 'value'])
+        while True:
+            rows = res.fetchmany(10000)
+            if not rows:
+                break
+            for row in rows:
+                t = int(row[0])
+                ts = datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc).strftime(TIMESTAMP)
+                csv_writer.writerow((t, ts, *row[1:]))
+            count += len(rows)
+
+    if not count:
+        os.remove(fname + '.csv')
@@ -30,11 +30,19 @@ for name in names:
         timeseries.append(name)
     elif name.startswith('idx_'):
         continue
-    elif name == 'bridge_stationStatus':
+    elif name.startswith('ts_rollup_'):
+        # aggregates of the ts_param_ tables
+        continue
+    elif name in ('bridge_stationStatus', 'bridge_eventState', 'bridge_retention', 'bridge_partition'):
+        if VERBOSE:
+            print('skipping', name)
+        continue
+    elif name in ('sqlite_autoindex_bridge_stationStatus_1', 'sqlite_autoindex_bridge_retention_1'):
         if VERBOSE:
             print('skipping', name)
         continue
-    elif name == 'sqlite_autoindex_bridge_stationStatus_1':
+    elif name in ('points', 'params', 'stations', 'strings') or name.startswith('sqlite_autoindex_'):
+        # the points layout
         if VERBOSE:
             print('skipping', name)
         continue
@@ -83,7 +91,7 @@ for ts in timeseries:
         rows = res.fetchone()[0]
         rows_param_station[param][station] = rows
 
-firstlast_query = 'SELECT * FROM {} ORDER BY time {} LIMIT 1'
+firstlast_query = 'SELECT time, station, value FROM {} ORDER BY time {} LIMIT 1'
 param_start = defaultdict(list)
 prefix_start = defaultdict(list)
 param_end = defaultdict(list)
@@ -15,10 +15,13 @@ setup_requires = ['setuptools_scm']
 
 extras_require = {
     'test': test_requires,  # setup no longer tests, so make them an extra that CI uses
+    'fast': ['orjson'],  # faster json decoding
+    'stream': ['ijson'],  # --stream
+    'parquet': ['pyarrow'],  # export --format parquet
 }
 
 scripts = []
-# 'create_tables.py', 'generate_types.py', 'insert_station.py', 'session-example.py', 'summarize_sqlite_db.py'
+# 'create_tables.py', 'generate_types.py', 'session-example.py', 'summarize_sqlite_db.py'
 
 this_directory = path.abspath(path.dirname(__file__))
 with open(path.join(this_directory, 'README.md'), encoding='utf-8') as f:
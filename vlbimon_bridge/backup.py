@@ -0,0 +1,127 @@
+'''
+Online backups that the bridge does not notice.
+
+The sqlite backup API copies --pages pages at a time, with a --sleep in
+between. The source connection holds one read transaction for the whole
+backup, so in WAL mode the bridge keeps writing and the copy is a
+consistent snapshot. Without the read transaction, every write by the
+bridge would restart the backup from the first page.
+'''
+
+import gzip
+import os
+import os.path
+import shutil
+import sys
+import time
+
+import sqlite3
+
+from . import partition
+from . import utils
+
+
+def backup_db(src, dest, pages=256, sleep=0.01, compress=False, verbose=0):
+    '''Back up the database src to the file dest, or dest.gz if compress.'''
+    if compress:
+        dest += '.gz'
+    tmp = dest + '.tmp'
+
+    src_con = sqlite3.connect(src)
+    mode = src_con.execute('PRAGMA journal_mode').fetchone()[0]
+    if mode != 'wal':
+        # a reader in a rollback journal database blocks writers
+        print('warning:', src, 'is not in WAL mode, writers will wait for the backup', file=sys.stderr)
+
+    db_tmp = tmp + '.db' if compress else tmp
+    dest_con = sqlite3.connect(db_tmp)
+
+    t0 = time.time()
+    last = [t0]
+
+    def progress(status, remaining, total):
+        now = time.time()
+        if verbose and now - last[0] > 10:
+            last[0] = now
+            print('  {}: {} of {} pages copied'.format(src, total - remaining, total), file=sys.stderr)
+        if sleep and remaining:
+            # lets the bridge get at the disk
+            time.sleep(sleep)
+
+    try:
+        # a snapshot for the whole backup
+        src_con.execute('BEGIN')
+        src_con.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        src_con.backup(dest_con, pages=pages, progress=progress)
+        src_con.rollback()
+
+        # the copy is a standalone file, not a WAL database without its -wal
+        dest_con.execute('PRAGMA journal_mode=DELETE')
+        dest_con.close()
+        src_con.close()
+
+        if compress:
+            with open(db_tmp, 'rb') as f_in, gzip.open(tmp, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.remove(db_tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        dest_con.close()
+        src_con.close()
+        for f in (tmp, db_tmp):
+            if os.path.exists(f):
+                os.remove(f)
+        raise
+
+    elapsed = time.time() - t0
+    size = os.path.getsize(src)
+    print('backed up {} to {}, {} MB in {} seconds, {} MB/s'.format(
+        src, dest, round(size / 1e6, 1), round(elapsed, 1), round(size / 1e6 / max(elapsed, 0.001), 1)), file=sys.stderr)
+    return dest
+
+
+def is_current(src, dest):
+    '''Is dest a backup of the read-only partition src that is still good?'''
+    if not os.path.exists(dest):
+        return False
+    if os.stat(src).st_mode & 0o222:
+        # still being written, or not yet frozen
+        return False
+    return os.path.getmtime(dest) >= os.path.getmtime(src)
+
+
+def backup(cmd):
+    verbose = cmd.verbose
+    sqlitedb = cmd.sqlitedb
+
+    if cmd.partitions:
+        if not os.path.isdir(cmd.dest):
+            raise ValueError('with --partitions, {} must be a directory'.format(cmd.dest))
+        srcs = [path for start, path in partition.get_partitions(sqlitedb)]
+        if not srcs:
+            raise ValueError('no partitions of {} found'.format(sqlitedb))
+    else:
+        if not os.path.isfile(sqlitedb):
+            raise ValueError('database file {} does not exist'.format(sqlitedb))
+        # a partition symlink is backed up under the name of the partition
+        srcs = [os.path.realpath(sqlitedb) if os.path.islink(sqlitedb) else sqlitedb]
+
+    t0 = time.time()
+    skipped = 0
+    for src in srcs:
+        utils.checkout_db(src, mode='r')
+        if os.path.isdir(cmd.dest):
+            dest = os.path.join(cmd.dest, os.path.basename(src))
+        else:
+            dest = cmd.dest
+        if cmd.partitions and is_current(src, dest + ('.gz' if cmd.gzip else '')):
+            # cold partitions only need backing up once
+            if verbose:
+                print('skipping', src, 'which is already backed up', file=sys.stderr)
+            skipped += 1
+            continue
+        backup_db(src, dest, pages=cmd.pages, sleep=cmd.sleep, compress=cmd.gzip, verbose=verbose)
+
+    if len(srcs) > 1:
+        print('backed up {} databases, skipped {}, in {} seconds'.format(
+            len(srcs) - skipped, skipped, round(time.time() - t0, 1)), file=sys.stderr)
@@ -0,0 +1,564 @@
+import asyncio
+import datetime
+import json
+import os
+import os.path
+import queue
+import sys
+import threading
+import time
+import sqlite3
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import checkpoint
+from . import client
+from . import partition
+from . import utils
+from . import transformer
+from . import sqlite
+
+
+def read_server_metadata(metadata_file, verbose=0):
+    sessionid = None
+    last_snap = int(time.time())
+    if os.path.isfile(metadata_file):
+        with open(metadata_file) as f:
+            try:
+                j = json.load(f)
+                sessionid = j['sessionid']
+                try:
+                    last_snap = int(j['last_snap'])
+                except ValueError:
+                    print('invalid last_snap in', metadata_file)
+            except json.JSONDecodeError as e:
+                print('surprised while reading {} by {}, ignoring metadata'.format(metadata_file, repr(e)), file=sys.stderr)
+        if verbose:
+            print('got a valid sessionid', sessionid, 'and last snap', last_snap)
+    return sessionid, last_snap
+
+
+class Snapshot:
+    __slots__ = ('now', 'bridge_lag', 'sessionid', 'last_snap', 'snap', 'metadata_file', 'http')
+
+    def __init__(self, now, bridge_lag, sessionid, last_snap, snap, metadata_file, http):
+        self.now = now
+        self.bridge_lag = bridge_lag
+        self.sessionid = sessionid
+        self.last_snap = last_snap
+        self.snap = snap
+        self.metadata_file = metadata_file
+        self.http = http
+
+
+def server_name(http):
+    return http.server.split('://', 1)[-1].rstrip('/')
+
+
+def retry_points(http, now):
+    '''Flat points for the retry state of one server, with the server name as the station.'''
+    changes, failures = http.retry.take()
+    station = server_name(http)
+    flat = [[station, 'bridge_circuitState', int(t), state] for t, state in changes]
+    flat.append([station, 'bridge_failures', int(now), failures])
+    return flat
+
+
+class Dedup:
+    '''Drops points that another server already reported, keyed on (station, param, time).
+
+    Remembers the last depth times seen for each (station, param). Snapshots
+    only carry the latest point of each param, so this covers a server that
+    is depth polls behind the other one.'''
+
+    def __init__(self, depth=16):
+        self.recent = defaultdict(lambda: deque(maxlen=depth))
+        self.dropped = 0
+
+    def filter(self, flat):
+        ret = []
+        for r in flat:
+            s, d, t = r[0], r[1], int(r[2])
+            recent = self.recent[(s, d)]
+            if t in recent:
+                self.dropped += 1
+                continue
+            recent.append(t)
+            ret.append(r)
+        return ret
+
+
+class Fetcher(threading.Thread):
+    '''Polls one vlbimon server every dt seconds and puts the snapshots on a bounded queue.
+
+    When the queue is full (the writer is behind) the poll is skipped. Nothing is
+    lost, because the next poll asks for everything since the last snapshot that
+    was queued.'''
+
+    def __init__(self, http, q, dt, sessionid, last_snap, metadata_file, verbose=0):
+        super().__init__(name='fetcher ' + http.server, daemon=True)
+        self.http = http
+        self.queue = q
+        self.dt = dt
+        self.sessionid = sessionid
+        self.last_snap = last_snap
+        self.metadata_file = metadata_file
+        self.verbose = verbose
+        self.stop = threading.Event()
+        self.skipped = 0
+
+    def skip(self):
+        self.skipped += 1
+        print('writer is behind, skipping a poll of {} ({} so far)'.format(self.http.server, self.skipped), file=sys.stderr)
+
+    def run(self):
+        if self.sessionid is None:
+            # here rather than in bridge(), so a server that is down does not hold up the others
+            self.sessionid = client.get_sessionid(self.http, verbose=self.verbose)
+        next_deadline = time.monotonic()
+        while not self.stop.is_set():
+            delta = next_deadline - time.monotonic()
+            if delta > 0:
+                if self.verbose:
+                    print('sleeping', round(delta, 3), 'seconds until the next deadline')
+                if self.stop.wait(delta):
+                    break
+            # schedule from the deadline, not from now, so the cadence does not drift
+            next_deadline = max(next_deadline + self.dt, time.monotonic())
+
+            if self.queue.full():
+                self.skip()
+                continue
+
+            now = time.time()
+            try:
+                self.sessionid, last_snap, snap = client.get_snapshot(self.http, last_snap=self.last_snap,
+                                                                      sessionid=self.sessionid, verbose=self.verbose)
+            except Exception as e:
+                print('fetcher saw', repr(e), file=sys.stderr)
+                continue
+            bridge_lag = time.time() - now
+            try:
+                # another fetcher might have filled the queue in the meantime
+                self.queue.put_nowait(Snapshot(now, bridge_lag, self.sessionid, last_snap, snap, self.metadata_file, self.http))
+            except queue.Full:
+                self.skip()
+                continue
+            self.last_snap = last_snap
+
+
+def get_batch(q, max_coalesce, timeout=1.):
+    '''Wait for one snapshot, then take up to max_coalesce-1 more if they are already waiting.'''
+    try:
+        batch = [q.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < max_coalesce:
+        try:
+            batch.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def write_batch(con, batch, stationStatus, dedup=None, checkpointer=None, verbose=0):
+    '''Write several snapshots in one transaction.'''
+    tables = utils.Batch()
+    for s in batch:
+        flat = s.snap if isinstance(s.snap, list) else utils.snapshot_records(s.snap)
+        if dedup:
+            flat = dedup.filter(flat)
+        utils.flatten(flat, bridge_lag=s.bridge_lag, add_points=True, batch=tables, verbose=verbose)
+        tables.extend(retry_points(s.http, s.now))
+    if checkpointer:
+        tables.extend(checkpointer.take_points())
+    status_table = transformer.transform_status(tables, stationStatus, verbose=verbose, dedup_events=True)
+    event_state = transformer.take_event_state()
+
+    retries = 0
+    while True:
+        try:
+            sqlite.insert_many_ts(con, tables, verbose=verbose)
+            sqlite.insert_many_status(con, status_table, verbose=verbose)
+            sqlite.insert_many_event_state(con, event_state, verbose=verbose)
+            con.commit()
+            break
+        except sqlite3.OperationalError as e:
+            # database is locked, for example by a checkpoint: write the whole batch again, and
+            # if that keeps failing, exit before last_snap moves past the unwritten snapshots
+            con.rollback()
+            sqlite.forget_schema(con)
+            retries += 1
+            if not sqlite.is_busy(e) or retries > 3:
+                raise
+            print('whoops! retrying the write after', repr(e), file=sys.stderr)
+    if checkpointer:
+        # a good time to checkpoint: the next commit is about --dt away
+        checkpointer.committed.set()
+
+    # do this after successful database writes, once per server
+    latest = {}
+    for s in batch:
+        latest[s.metadata_file] = s
+    for metadata_file, s in latest.items():
+        utils.write_json_atomic(metadata_file, {'sessionid': s.sessionid, 'last_snap': s.last_snap}, sort_keys=True)
+
+
+def roll_partition(con, partitions, wal_size=None, checkpointer=None, verbose=0):
+    '''At a partition boundary, close con and return a connection to the new partition.'''
+    if partitions.due(time.time()):
+        previous = partitions.roll(time.time())
+        con.close()
+        con = sqlite.connect(partitions.current, wal_size=wal_size, verbose=verbose)
+        if checkpointer:
+            checkpointer.switch(partitions.current)
+        partitions.retire(previous)
+    partitions.freeze_pending()
+    return con
+
+
+def start_checkpointer(cmd, dbfile, verbose=0):
+    '''Return a running Checkpointer for dbfile, or None without --checkpoint.'''
+    if not cmd.checkpoint:
+        return None
+    checkpointer = checkpoint.Checkpointer(dbfile, cmd.checkpoint, int(cmd.wal_budget * 1e6), verbose=verbose)
+    checkpointer.start()
+    return checkpointer
+
+
+def stop_checkpointer(checkpointer):
+    if checkpointer:
+        checkpointer.stop.set()
+        # it is at most one checkpoint away from noticing
+        checkpointer.join(timeout=10)
+
+
+def in_daemon_thread(func, *args, **kwargs):
+    '''Run a blocking call in a new daemon thread, returning an awaitable for its result.
+
+    Unlike an executor thread, a daemon thread stuck in a slow request or in
+    client.create_session's retry loop does not keep the process from exiting.'''
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(method, value):
+        if not future.done():  # the awaiting task might have been cancelled
+            getattr(future, method)(value)
+
+    def target():
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            method, value = 'set_exception', e
+        else:
+            method, value = 'set_result', result
+        try:
+            loop.call_soon_threadsafe(settle, method, value)
+        except RuntimeError:
+            pass  # the loop has closed, nobody is waiting
+
+    threading.Thread(target=target, name=func.__name__, daemon=True).start()
+    return future
+
+
+class AsyncFetcher:
+    '''Polls one vlbimon server from asyncio tasks: a poller and a session renewer.
+
+    The poller runs on the event loop's monotonic clock and only ever waits on
+    its deadlines. The blocking requests calls run in daemon threads, so neither
+    a slow server nor a session renewal delays the next deadline. A poll is
+    skipped if the previous one is still in flight, if there is no session, or
+    if the writer is behind; nothing is lost, because the next poll asks for
+    everything since the last snapshot that was queued.'''
+
+    def __init__(self, http, dt, sessionid, last_snap, metadata_file, verbose=0):
+        self.http = http
+        self.dt = dt
+        self.sessionid = sessionid
+        self.last_snap = last_snap
+        self.metadata_file = metadata_file
+        self.verbose = verbose
+        self.skipped = 0
+
+    def skip(self, why):
+        self.skipped += 1
+        print('{}, skipping a poll of {} ({} so far)'.format(why, self.http.server, self.skipped), file=sys.stderr)
+
+    async def run(self, q, exit_file):
+        self.queue = q
+        self.have_session = asyncio.Event()
+        self.need_session = asyncio.Event()
+        if self.sessionid is None:
+            self.need_session.set()
+        else:
+            self.have_session.set()
+
+        renewer = asyncio.create_task(self.renew_sessions())
+        try:
+            await self.poll(exit_file)
+        finally:
+            renewer.cancel()
+
+    async def poll(self, exit_file):
+        loop = asyncio.get_running_loop()
+        next_deadline = loop.time()  # monotonic
+        fetch = None
+        while True:
+            delta = next_deadline - loop.time()
+            if delta > 0:
+                if self.verbose:
+                    print('sleeping', round(delta, 3), 'seconds until the next deadline')
+                await asyncio.sleep(delta)
+            # schedule from the deadline, not from now, so the cadence does not drift
+            next_deadline = max(next_deadline + self.dt, loop.time())
+
+            if os.path.exists(exit_file):
+                if fetch is not None:
+                    await fetch
+                return
+
+            if fetch is not None and not fetch.done():
+                self.skip('previous poll still in flight')
+            elif not self.have_session.is_set():
+                self.skip('waiting for a session')
+            elif self.queue.full():
+                self.skip('writer is behind')
+            else:
+                fetch = asyncio.create_task(self.fetch())
+
+    async def fetch(self):
+        now = time.time()
+        try:
+            sessionid, last_snap, snap = await in_daemon_thread(client.get_snapshot, self.http, last_snap=self.last_snap,
+                                                                sessionid=self.sessionid, renew=False, verbose=self.verbose)
+        except Exception as e:
+            print('fetcher saw', repr(e), file=sys.stderr)
+            return
+        bridge_lag = time.time() - now
+        if sessionid is None:
+            # renew concurrently, polls are skipped until it is done
+            self.sessionid = None
+            self.have_session.clear()
+            self.need_session.set()
+            return
+        try:
+            # another fetcher might have filled the queue in the meantime
+            self.queue.put_nowait(Snapshot(now, bridge_lag, sessionid, last_snap, snap, self.metadata_file, self.http))
+        except asyncio.QueueFull:
+            self.skip('writer is behind')
+            return
+        self.last_snap = last_snap
+
+    async def renew_sessions(self):
+        while True:
+            await self.need_session.wait()
+            self.sessionid = await in_daemon_thread(client.get_sessionid, self.http, self.sessionid, verbose=self.verbose)
+            if self.verbose:
+                print('got session', self.sessionid, 'from', self.http.server)
+            self.need_session.clear()
+            self.have_session.set()
+
+
+class AsyncBridge:
+    '''AsyncFetchers feeding a writer task, which writes from a single executor thread.'''
+
+    def __init__(self, cmd, fetchers, stations, exit_file, dedup=None, partitions=None):
+        self.cmd = cmd
+        self.verbose = cmd.verbose
+        self.fetchers = fetchers
+        self.stations = stations
+        self.exit_file = exit_file
+        self.dedup = dedup
+        self.partitions = partitions
+        # sqlite3 connections belong to the thread that made them: make and use it in this one
+        self.write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+        # the checkpointer replaces wal_autocheckpoint
+        self.wal_size = 0 if cmd.checkpoint else cmd.wal
+        self.con = None
+        self.stationStatus = None
+        self.checkpointer = None
+
+    def open_db(self):
+        dbfile = self.partitions.open(time.time()) if self.partitions else self.cmd.sqlitedb
+        self.con = sqlite.connect(dbfile, wal_size=self.wal_size, verbose=self.verbose)
+        self.checkpointer = start_checkpointer(self.cmd, dbfile, verbose=self.verbose)
+        self.stationStatus = transformer.init_stationStatus(self.con, self.stations, verbose=self.verbose)
+        transformer.init_event_state(self.con, verbose=self.verbose)
+
+    def write_batch(self, batch):
+        # runs in the write thread
+        if self.partitions:
+            self.con = roll_partition(self.con, self.partitions, wal_size=self.wal_size,
+                                      checkpointer=self.checkpointer, verbose=self.verbose)
+        write_batch(self.con, batch, self.stationStatus, self.dedup, checkpointer=self.checkpointer, verbose=self.verbose)
+
+    def close(self):
+        stop_checkpointer(self.checkpointer)
+        if self.con is not None:
+            # queued behind any write in progress
+            self.write_pool.submit(self.con.close).result()
+            self.con = None
+        self.write_pool.shutdown()
+        for f in self.fetchers:
+            f.http.close()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue(maxsize=self.cmd.queue)
+        await loop.run_in_executor(self.write_pool, self.open_db)
+
+        writer = asyncio.create_task(self.write(q))
+        fetching = asyncio.gather(*(f.run(q, self.exit_file) for f in self.fetchers))
+        await asyncio.wait((writer, fetching), return_when=asyncio.FIRST_COMPLETED)
+        if writer.done():
+            # the writer only returns after the None put below, so it failed: like the threaded
+            # bridge, exit instead of polling into a queue that nobody drains
+            fetching.cancel()
+            await asyncio.gather(fetching, return_exceptions=True)
+            writer.result()
+        fetching.result()  # raises if a fetcher failed
+
+        sys.stdout.flush()
+        print('exiting on', self.exit_file, file=sys.stderr)
+        # tells the writer to finish up, unless it fails while the queue is full
+        finish = asyncio.create_task(q.put(None))
+        await asyncio.wait((finish, writer), return_when=asyncio.FIRST_COMPLETED)
+        finish.cancel()
+        await writer
+        try:
+            os.remove(self.exit_file)
+        except FileNotFoundError:
+            pass
+
+    async def write(self, q):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await q.get()]
+            while len(batch) < self.cmd.coalesce and not q.empty():
+                batch.append(q.get_nowait())
+            finished = batch[-1] is None
+            batch = [s for s in batch if s is not None]
+            if batch:
+                # one snapshot per server per poll is keeping up
+                if len(batch) > len(self.fetchers):
+                    print('writer is behind, writing', len(batch), 'snapshots in one transaction', file=sys.stderr)
+                await loop.run_in_executor(self.write_pool, self.write_batch, batch)
+            if finished:
+                return
+
+
+def bridge_async(cmd, fetchers, stations, exit_file, dedup=None, partitions=None):
+    b = AsyncBridge(cmd, fetchers, stations, exit_file, dedup=dedup, partitions=partitions)
+    try:
+        asyncio.run(b.run())
+    except KeyboardInterrupt:
+        sys.stdout.flush()
+        print('^C seen, gracefully closing database', file=sys.stderr, flush=True)
+        raise
+    finally:
+        b.close()
+
+
+def start_state(cmd, http, datadir, verbose=0):
+    '''Work out the metadata file, sessionid and last_snap to start from.'''
+    os.makedirs(datadir, exist_ok=True)
+    metadata_file = datadir + '/' + server_name(http) + '.json'
+    sessionid, last_snap = read_server_metadata(metadata_file, verbose=verbose)
+    if cmd.start is not None:  # overrides .json last_snap
+        if cmd.start == 0:
+            last_snap = int(time.time())
+        else:
+            last_snap = cmd.start
+    delta = int(time.time() - last_snap)
+    if delta < 0:
+        last_snap = int(time.time())
+        delta = 0
+    if verbose:
+        print(http.server, 'fetching data starting', delta, 'seconds ago')
+    return metadata_file, sessionid, last_snap
+
+
+def bridge(cmd):
+    verbose = cmd.verbose
+    datadir = cmd.datadir.rstrip('/')
+    # the checkpointer replaces wal_autocheckpoint
+    wal_size = 0 if cmd.checkpoint else cmd.wal
+    exit_file = datadir + '/PLEASE-EXIT'
+
+    print('bridge starting', datetime.datetime.now(datetime.timezone.utc).isoformat(), file=sys.stderr, flush=True)
+
+    partitions = None
+    if cmd.partition:
+        # checks the symlink and the partitions when it opens them
+        partitions = partition.Partitions(cmd.sqlitedb, cmd.partition, campaigns=cmd.campaigns, verbose=verbose)
+    elif not os.path.isfile(cmd.sqlitedb):
+        # error out early if the db doesn't exist
+        raise ValueError('database file {} does not exist'.format(cmd.sqlitedb))
+    utils.setup_groups(verbose=verbose)
+
+    stations = transformer.init(verbose=verbose)
+    stations = cmd.stations or stations
+
+    https = client.get_clients(cmd, verbose=verbose)
+    states = [start_state(cmd, http, datadir, verbose=verbose) for http in https]
+    # both servers report the same points
+    dedup = Dedup() if len(https) > 1 else None
+
+    if cmd.asyncio:
+        fetchers = [AsyncFetcher(http, cmd.dt, sessionid, last_snap, metadata_file, verbose=verbose)
+                    for http, (metadata_file, sessionid, last_snap) in zip(https, states)]
+        return bridge_async(cmd, fetchers, stations, exit_file, dedup=dedup, partitions=partitions)
+
+    dbfile = partitions.open(time.time()) if partitions else cmd.sqlitedb
+    con = sqlite.connect(dbfile, wal_size=wal_size, verbose=verbose)
+    checkpointer = start_checkpointer(cmd, dbfile, verbose=verbose)
+    stationStatus = transformer.init_stationStatus(con, stations, verbose=verbose)
+    transformer.init_event_state(con, verbose=verbose)
+
+    q = queue.Queue(maxsize=cmd.queue)
+    fetchers = []
+    for http, (metadata_file, sessionid, last_snap) in zip(https, states):
+        fetchers.append(Fetcher(http, q, cmd.dt, sessionid, last_snap, metadata_file, verbose=verbose))
+    for fetcher in fetchers:
+        fetcher.start()
+
+    try:
+        while True:
+            batch = get_batch(q, cmd.coalesce)
+            if partitions:
+                con = roll_partition(con, partitions, wal_size=wal_size, checkpointer=checkpointer, verbose=verbose)
+            if batch:
+                # one snapshot per server per poll is keeping up
+                if len(batch) > len(fetchers):
+                    print('writer is behind, writing', len(batch), 'snapshots in one transaction', file=sys.stderr)
+                write_batch(con, batch, stationStatus, dedup=dedup, checkpointer=checkpointer, verbose=verbose)
+
+            if os.path.exists(exit_file):
+                sys.stdout.flush()
+                print('exiting on', exit_file, file=sys.stderr)
+                for fetcher in fetchers:
+                    fetcher.stop.set()
+                for fetcher in fetchers:
+                    # one that is still trying to get a session has nothing to hand over
+                    fetcher.join(timeout=cmd.connect_timeout + cmd.read_timeout)
+                batch = get_batch(q, cmd.queue, timeout=0.)
+                if batch:
+                    write_batch(con, batch, stationStatus, dedup=dedup, checkpointer=checkpointer, verbose=verbose)
+                try:
+                    os.remove(exit_file)
+                except FileNotFoundError:
+                    pass
+                break
+        for http in https:
+            http.close()
+        stop_checkpointer(checkpointer)
+    except KeyboardInterrupt:
+        for fetcher in fetchers:
+            fetcher.stop.set()
+        sys.stdout.flush()
+        print('^C seen, gracefully closing database', file=sys.stderr, flush=True)
+        stop_checkpointer(checkpointer)
+        con.close()
+        raise
+    if dedup and verbose:
+        print('dropped', dedup.dropped, 'points that were reported by both servers', file=sys.stderr)
@@ -0,0 +1,115 @@
+'''
+WAL checkpoints off the bridge's write path.
+
+With wal_autocheckpoint, the checkpoint runs inside whichever commit
+makes the WAL cross --wal pages, and that commit takes much longer than
+the others. With bridge --checkpoint, the bridge sets wal_autocheckpoint=0
+and a Checkpointer thread, with its own connection, runs a PASSIVE
+checkpoint just after a commit, at most every --checkpoint seconds.
+PASSIVE never waits for anyone, so the next commit is not held up.
+
+A reader such as Grafana that is in the middle of a query keeps the WAL
+from being reset, so a busy database's WAL can grow without bound. When
+the WAL file is bigger than --wal-budget MB and the PASSIVE checkpoint
+managed to copy every frame, it is followed by a TRUNCATE, which waits
+briefly for the readers to finish, restarts the WAL and truncates the
+file. The copy is already done by then, so the TRUNCATE holds the write
+lock only briefly.
+
+The checkpoint times and WAL sizes are handed to the writer, which
+writes them as bridge_checkpointTime and bridge_walSize.
+'''
+
+import os.path
+import sys
+import threading
+import time
+
+import sqlite3
+
+
+class Checkpointer(threading.Thread):
+    def __init__(self, path, interval, budget, busy_timeout=50, verbose=0):
+        '''budget in bytes. busy_timeout is in ms, and must be shorter than the bridge's, because a
+        TRUNCATE checkpoint keeps the bridge from writing while it waits for readers.'''
+        super().__init__(daemon=True, name='checkpointer')
+        self.path = path
+        self.interval = interval
+        self.budget = budget
+        self.busy_timeout = busy_timeout
+        self.verbose = verbose
+        self.stop = threading.Event()
+        self.committed = threading.Event()
+        self.lock = threading.Lock()
+        self.points = []
+
+    def switch(self, path):
+        '''Checkpoint path from now on, for example after a partition rollover.'''
+        self.path = path
+
+    def take_points(self):
+        '''Return the flat [station, param, time, value] records since the last call. Called by the writer.'''
+        with self.lock:
+            points, self.points = self.points, []
+        return points
+
+    def wal_size(self, path):
+        try:
+            return os.path.getsize(path + '-wal')
+        except FileNotFoundError:
+            return 0
+
+    def checkpoint(self, con, path):
+        wal_size = self.wal_size(path)
+        mode = 'PASSIVE'
+        t0 = time.time()
+        try:
+            busy, log_frames, checkpointed = con.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            if wal_size > self.budget and not busy and checkpointed == log_frames:
+                # everything is already copied into the database, so TRUNCATE only has to wait
+                # for the readers and reset the WAL, and does not hold up the bridge for the copy
+                mode = 'TRUNCATE'
+                busy, log_frames, checkpointed = con.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        except sqlite3.OperationalError as e:
+            # locked by another checkpointer, such as sqlite-backup.py
+            print('checkpoint failed:', repr(e), file=sys.stderr)
+            return
+        elapsed = time.time() - t0
+
+        if wal_size > self.budget or self.verbose > 1:
+            print('{} checkpoint of a {} MB WAL took {} seconds, {} of {} frames checkpointed{}'.format(
+                mode, round(wal_size / 1e6, 1), round(elapsed, 3), checkpointed, log_frames,
+                ', readers are in the way' if busy else ''), file=sys.stderr)
+
+        now = int(time.time())
+        with self.lock:
+            self.points.append(['bridge', 'bridge_checkpointTime', now, elapsed])
+            self.points.append(['bridge', 'bridge_walSize', now, wal_size])
+
+    def run(self):
+        con = None
+        con_path = None
+        last = 0
+        try:
+            while not self.stop.is_set():
+                # the next checkpoint is due after interval, and best done just after a commit
+                wait = last + self.interval - time.time()
+                if wait > 0 and self.stop.wait(wait):
+                    break
+                self.committed.clear()
+                self.committed.wait(self.interval)
+                if self.stop.is_set():
+                    break
+
+                path = self.path
+                if con_path != path:
+                    if con is not None:
+                        con.close()
+                    con = sqlite3.connect(path)
+                    con.execute('PRAGMA busy_timeout={}'.format(self.busy_timeout))
+                    con_path = path
+                last = time.time()
+                self.checkpoint(con, path)
+        finally:
+            if con is not None:
+                con.close()
@@ -1,16 +1,14 @@
 from argparse import ArgumentParser
-import time
-import datetime
-import os
-import os.path
-import json
-import sys
 
 from . import history
-from . import client
-from . import utils
-from . import transformer
 from . import sqlite
+from . import load
+from . import bridge
+from . import partition
+from . import export
+from . import rollup
+from . import retention
+from . import backup
 
 
 def main(args=None):
@@ -18,131 +16,105 @@ def main(args=None):
 
     parser.add_argument('--verbose', '-v', action='count', default=0, help='be verbose')
     parser.add_argument('-1', dest='one', action='store_true', help='use vlbimon1 (default)')
-    parser.add_argument('-2', dest='two', action='store_true', help='use vlbimon2 (default is vlbimon1)')
+    parser.add_argument('-2', dest='two', action='store_true', help='use vlbimon2 (default is vlbimon1). bridge -1 -2 polls both')
     parser.add_argument('--stations', action='append', help='stations to process (default all)')
     parser.add_argument('--datadir', action='store', default='data', help='directory to write output in (default ./data)')
     parser.add_argument('--secrets', action='store', default='~/.vlbimonitor-secrets.yaml', help='file containing auth secrets, default ~/.vlbimonitor-secrets.yaml')
+    parser.add_argument('--connect-timeout', action='store', type=float, default=10., help='http connect timeout, seconds, default=10')
+    parser.add_argument('--read-timeout', action='store', type=float, default=60., help='http read timeout, seconds, default=60')
+    parser.add_argument('--stream', action='store_true', help='decode responses incrementally as they arrive (needs ijson)')
 
     subparsers = parser.add_subparsers(dest='cmd')
     subparsers.required = True
 
     hist = subparsers.add_parser('history', help='download historical vlbimon data to csv files')
     hist.add_argument('--start', action='store', type=int, help='start time (unixtime integer)')
-    hist.add_argument('--end', action='store', type=int, help='end time (unixtime integer)')
+    hist.add_argument('--end', action='store', type=int, help='end time (unixtime integer) (default now)')
+    hist.add_argument('--resume', action='store_true', help='start each param where the last run left off (metadata.json last_tried)')
     hist.add_argument('--all', action='store_true', help='process all public and private parameters')
     hist.add_argument('--public', action='store_true', help='process public parameters (year round)')
     hist.add_argument('--private', action='store_true', help='process private parameters (during EHT obs)')
     hist.add_argument('--param', action='append', help='param to process (default all)')
+    hist.add_argument('--workers', action='store', type=int, default=4, help='number of concurrent downloads, default=4')
+    hist.add_argument('--rate', action='store', type=float, default=2., help='limit on requests per second to the server, default=2')
+    hist.add_argument('--target-points', action='store', type=int, default=500, help='size each request to return about this many points, default=500')
     hist.set_defaults(func=history.history)
 
     initdb = subparsers.add_parser('initdb', help='initialize a sqlite database')
     initdb.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the output database; elsewise, print to stdout')
+    initdb.add_argument('--index', action='store', choices=sorted(sqlite.index_modes), default='separate',
+                        help='indexes for the timeseries tables: separate time and station (default), composite (station, time), or covering (station, time, value)')
+    initdb.add_argument('--layout', action='store', choices=sqlite.layouts, default='rowid',
+                        help='timeseries storage: rowid tables plus indexes (default), clustered WITHOUT ROWID tables, '
+                        'or one points table with ts_param_ views (the last two ignore --index)')
+    initdb.add_argument('--intern', action='store_true', help='with --layout points, also store each distinct string value only once')
     initdb.set_defaults(func=sqlite.initdb)
 
-    bridge = subparsers.add_parser('bridge', help='bridge data from vlbimon into a sqlite database')
-    bridge.add_argument('--start', action='store', type=int, help='start time (unixtime integer) (0=now) (default reads data/server.json last_snap)')
-    bridge.add_argument('--dt', action='store', type=int, default=10, help='time between calls, seconds, default=10')
-    bridge.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the output database; elsewise, print to stdout')
-    bridge.add_argument('--wal', action='store', type=int, default=1000, help='size of the write ahead log, default 1000 4k pages. 0 to disable.')
-    bridge.set_defaults(func=bridge_cli)
+    load_ = subparsers.add_parser('load', help='load csv files from the history command into a sqlite database')
+    load_.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the database, which must already exist (see initdb)')
+    load_.add_argument('--param', action='append', help='param to process (default all)')
+    load_.add_argument('--batch', action='store', type=int, default=100000, help='rows per insert batch, default=100000')
+    load_.set_defaults(func=load.load)
+
+    export_ = subparsers.add_parser('export', help='export timeseries tables from a sqlite database to files in --datadir')
+    export_.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the database')
+    export_.add_argument('--param', action='append', help='param to export (default all)')
+    export_.add_argument('--match', action='append', help='export params containing this string')
+    export_.add_argument('--start', action='store', type=int, help='start time (unixtime integer)')
+    export_.add_argument('--end', action='store', type=int, help='end time (unixtime integer), not included')
+    export_.add_argument('--format', action='store', choices=export.formats, default='csv', help='output format, default csv. parquet needs pyarrow')
+    export_.add_argument('--workers', action='store', type=int, default=4, help='number of tables exported concurrently, default=4')
+    export_.add_argument('--partitions', action='store_true', help='read all of the partitions of --sqlitedb that overlap --start and --end')
+    export_.add_argument('--batch', action='store', type=int, default=10000, help='rows fetched at a time, default=10000')
+    export_.set_defaults(func=export.export)
+
+    rollup_ = subparsers.add_parser('rollup', help='create and backfill the rollup tables of a sqlite database')
+    rollup_.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the database')
+    rollup_.add_argument('--param', action='append', help='param to process (default all)')
+    rollup_.add_argument('--start', action='store', type=int, help='start time (unixtime integer), rounded down to the hour')
+    rollup_.add_argument('--end', action='store', type=int, help='end time (unixtime integer), rounded up to the hour')
+    rollup_.add_argument('--batch', action='store', type=int, default=20000, help='about this many points rolled up per transaction, default=20000')
+    rollup_.add_argument('--pause', action='store', type=float, default=0.05, help='seconds between transactions, default=0.05')
+    rollup_.set_defaults(func=rollup.rollup)
+
+    retention_ = subparsers.add_parser('retention', help='delete or thin old points, as configured in --config')
+    retention_.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the database')
+    retention_.add_argument('--config', action='store', default='retention.yaml', help='retention policies, default retention.yaml')
+    retention_.add_argument('--param', action='append', help='param to process (default all)')
+    retention_.add_argument('--dry-run', action='store_true', help='count the points that would be deleted')
+    retention_.add_argument('--batch', action='store', type=int, default=2000, help='about this many points deleted per transaction, default=2000')
+    retention_.add_argument('--pause', action='store', type=float, default=0.05, help='seconds between transactions, default=0.05')
+    retention_.add_argument('--vacuum-pages', action='store', type=int, default=1000, help='pages freed per incremental vacuum transaction, default=1000')
+    retention_.add_argument('--no-vacuum', action='store_true', help='do not give the free pages back to the filesystem')
+    retention_.set_defaults(func=retention.retention)
+
+    backup_ = subparsers.add_parser('backup', help='back up a sqlite database while the bridge is writing it')
+    backup_.add_argument('dest', help='backup file, or directory to put it in')
+    backup_.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the database')
+    backup_.add_argument('--pages', action='store', type=int, default=256, help='pages copied per step, default=256')
+    backup_.add_argument('--sleep', action='store', type=float, default=0.01, help='seconds between steps, default=0.01')
+    backup_.add_argument('--gzip', action='store_true', help='compress the backup')
+    backup_.add_argument('--partitions', action='store_true', help='back up all of the partitions of --sqlitedb into the dest directory, '
+                         'skipping read-only partitions that are already backed up')
+    backup_.set_defaults(func=backup.backup)
+
+    bridge_ = subparsers.add_parser('bridge', help='bridge data from vlbimon into a sqlite database')
+    bridge_.add_argument('--start', action='store', type=int, help='start time (unixtime integer) (0=now) (default reads data/server.json last_snap)')
+    bridge_.add_argument('--dt', action='store', type=int, default=10, help='time between calls, seconds, default=10')
+    bridge_.add_argument('--sqlitedb', action='store', default='vlbimon.db', help='name of the output database; elsewise, print to stdout')
+    bridge_.add_argument('--wal', action='store', type=int, default=1000, help='size of the write ahead log, default 1000 4k pages. 0 to disable.')
+    bridge_.add_argument('--checkpoint', action='store', type=float, default=0,
+                         help='checkpoint the WAL in a background thread at most every this many seconds, instead of every --wal pages')
+    bridge_.add_argument('--wal-budget', action='store', type=float, default=64,
+                         help='with --checkpoint, WAL size in MB over which the checkpoint waits for readers and truncates the WAL, default=64')
+    bridge_.add_argument('--queue', action='store', type=int, default=6, help='snapshots waiting to be written before polls are skipped, default=6')
+    bridge_.add_argument('--coalesce', action='store', type=int, default=6, help='most snapshots written in one transaction, default=6')
+    bridge_.add_argument('--asyncio', action='store_true', help='poll, renew sessions and write concurrently in asyncio tasks')
+    bridge_.add_argument('--partition', action='store', choices=partition.schemes,
+                         help='write a new database file every month, or every campaign in --campaigns. --sqlitedb is a symlink to the current one')
+    bridge_.add_argument('--campaigns', action='store', help='yaml file of campaign names and start and end times, for --partition')
+    bridge_.set_defaults(func=bridge.bridge)
 
     cmd = parser.parse_args(args=args)
     return cmd.func(cmd)
 
-
-def bridge_cli(cmd):
-    verbose = cmd.verbose
-    datadir = cmd.datadir.rstrip('/')
-    secrets = cmd.secrets
-    wal_size = cmd.wal
-    exit_file = datadir + '/PLEASE-EXIT'
-
-    print('bridge starting', datetime.datetime.now(datetime.timezone.utc).isoformat(), file=sys.stderr, flush=True)
-
-    if not os.path.isfile(cmd.sqlitedb):
-        # error out early if the db doesn't exist
-        raise ValueError('database file {} does not exist'.format(cmd.sqlitedb))
-    utils.setup_groups(verbose=verbose)
-
-    stations = transformer.init(verbose=verbose)
-    stations = cmd.stations or stations
-
-    server, auth = client.get_server(cmd.two, secrets=secrets, verbose=verbose)
-
-    os.makedirs(datadir, exist_ok=True)
-    clean_server = server.replace('https://', '', 1).rstrip('/')
-    metadata_file = datadir + '/' + clean_server + '.json'
-    sessionid = None
-    last_snap = int(time.time())
-    if os.path.isfile(metadata_file):
-        with open(metadata_file) as f:
-            try:
-                j = json.load(f)
-                sessionid = j['sessionid']
-                try:
-                    last_snap = int(j['last_snap'])
-                except ValueError:
-                    print('invalid last_snap in', metadata_file)
-            except json.JSONDecodeError as e:
-                print('surprised while reading {} by {}, ignoring metadata'.format(metadata_file, repr(e)), file=sys.stderr)
-        if verbose:
-            print('got a valid sessionid', sessionid, 'and last snap', last_snap)
-    if sessionid is None:
-        sessionid = client.get_sessionid(server, auth=auth, verbose=verbose)
-        # last_snap already set
-    if cmd.start is not None:  # overrides .json last_snap
-        if cmd.start == 0:
-            last_snap = int(time.time())
-        else:
-            last_snap = cmd.start
-    delta = int(time.time() - last_snap)
-    if delta < 0:
-        last_snap = int(time.time())
-        delta = 0
-    if verbose:
-        print('fetching data starting', delta, 'seconds ago')
-
-    next_deadline = 0
-    con = sqlite.connect(cmd.sqlitedb, wal_size=wal_size, verbose=verbose)
-    stationStatus = transformer.init_stationStatus(con, stations, verbose=verbose)
-
-    try:
-        while True:
-            if next_deadline:
-                delta = next_deadline - time.time()
-                if delta > 0:
-                    if verbose:
-                        print('sleeping', round(delta, 3), 'seconds until the next deadline')
-                    time.sleep(delta)
-            now = time.time()
-            next_deadline = now + cmd.dt
-
-            sessionid, last_snap, snap = client.get_snapshot(server, last_snap=last_snap, sessionid=sessionid, auth=auth, verbose=verbose)
-            bridge_lag = time.time() - now
-            flat = utils.flatten(snap, bridge_lag=bridge_lag, add_points=True, verbose=verbose)
-            flat = transformer.transform(flat, verbose=verbose, dedup_events=True)
-            tables = utils.flat_to_tables(flat)
-            status_table = transformer.update_stationStatus(stationStatus, tables, verbose=verbose)
-
-            sqlite.insert_many_ts(con, tables, verbose=verbose)
-            sqlite.insert_many_status(con, status_table, verbose=verbose)
-            con.commit()
-
-            with open(metadata_file, 'w') as f:
-                # do this after successful database writes
-                # XXX maybe new + os.replace()
-                json.dump({'sessionid': sessionid, 'last_snap': last_snap}, f, sort_keys=True)
-
-            if os.path.exists(exit_file):
-                sys.stdout.flush()
-                print('exiting on', exit_file, file=sys.stderr)
-                try:
-                    os.remove(exit_file)
-                except FileNotFoundError:
-                    pass
-                break
-    except KeyboardInterrupt:
-        sys.stdout.flush()
-        print('^C seen, gracefully closing database', file=sys.stderr, flush=True)
-        con.close()
-        raise
@@ -1,9 +1,15 @@
 import yaml
 import requests
+import requests.adapters
+from http.cookiejar import DefaultCookiePolicy
 import os.path
-import json
+import email.utils
+import random
 import time
 import sys
+import threading
+
+from . import decode
 
 '''
 example ~/.vlbimonitor-secrets.yaml:
@@ -55,7 +61,215 @@ def get_auth(server, secrets='~/.vlbimonitor-secrets.yaml', verbose=0):
     raise ValueError('failed to find auth information in {} for server {}, please check the format'.format(secrets, server))
 
 
-def get_history(server, datafields, observatories, start_timestamp, end_timestamp, auth=None, verbose=0):
+class RateLimiter:
+    '''Token bucket limiting the requests per second made by all threads sharing it.'''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.
+        if delay > 0:
+            time.sleep(delay)
+
+
+def retry_after(resp):
+    '''Seconds asked for by a Retry-After header, or None.'''
+    if resp is None:
+        return None
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0., when.timestamp() - time.time())
+
+
+class RetryPolicy:
+    '''Exponential backoff with jitter, plus a circuit breaker, shared by all calls to one server.
+
+    After n consecutive failures the next request waits between half and all of
+    base * 2**(n-1) seconds, at most max_delay, or longer if the server sent a
+    Retry-After. After threshold consecutive failures the circuit opens: no
+    requests for cooldown seconds, after which it is half-open and a single
+    probe request decides whether it closes again or reopens. Other callers
+    are held off until the probe's success() or failure(), or until
+    probe_timeout seconds pass without either.'''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name='', base=1., max_delay=300., threshold=5, cooldown=60., probe_timeout=None):
+        self.name = name
+        self.base = base
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = cooldown if probe_timeout is None else probe_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.not_before = 0.
+        self.probe = None  # thread ident of the half-open probe in flight
+        self.probe_deadline = 0.
+        self.changes = []  # (unixtime, state), see take()
+        self.lock = threading.Lock()
+
+    def change(self, state):
+        if state != self.state:
+            print('circuit for', self.name, 'is now', state)
+            self.state = state
+            self.changes.append((time.time(), state))
+
+    def delay(self):
+        '''Seconds until the next request may be made, 0 if it may be made now.
+
+        When half-open, 0 makes the caller the probe, and it must then call
+        success(), failure() or release().'''
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and now >= self.not_before:
+                self.change(self.HALF_OPEN)
+            delay = max(0., self.not_before - now)
+            if self.state != self.HALF_OPEN or delay > 0:
+                return delay
+            me = threading.get_ident()
+            if self.probe is None or self.probe == me or now >= self.probe_deadline:
+                self.probe = me
+                self.probe_deadline = now + self.probe_timeout
+                return 0.
+            # another caller's probe is in flight
+            return min(1., self.probe_deadline - now)
+
+    def allow(self):
+        return self.delay() == 0.
+
+    def wait(self):
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def release(self):
+        '''The request said nothing about the server's health, let another probe through.'''
+        with self.lock:
+            if self.probe == threading.get_ident():
+                self.probe = None
+
+    def success(self):
+        with self.lock:
+            self.probe = None
+            self.failures = 0
+            self.not_before = 0.
+            self.change(self.CLOSED)
+
+    def failure(self, retry_after=None):
+        '''Record a failure, returning the number of seconds before the next request.'''
+        with self.lock:
+            self.probe = None
+            self.failures += 1
+            delay = min(self.max_delay, self.base * 2 ** min(self.failures - 1, 30))
+            delay = random.uniform(delay / 2, delay)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_delay))
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.change(self.OPEN)
+                delay = max(delay, self.cooldown)
+            self.not_before = time.monotonic() + delay
+            return delay
+
+    def take(self):
+        '''Return the state changes since the last call, and the consecutive failures.'''
+        with self.lock:
+            changes, self.changes = self.changes, []
+            return changes, self.failures
+
+
+class HTTPClient:
+    '''A pooled, keep-alive connection to one vlbimon server.
+
+    Create one of these per server and pass it to the functions below, so that
+    the TCP+TLS handshake is paid once instead of once per call.'''
+
+    def __init__(self, server, auth=None, pool_connections=1, pool_maxsize=4,
+                 connect_timeout=10., read_timeout=60., rate=None, retry=None, stream=False, verbose=0):
+        if stream:
+            decode.check_streaming()
+        self.server = server
+        self.stream = stream
+        self.auth = auth
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = RateLimiter(rate) if rate else None
+        self.retry = retry or RetryPolicy(name=server)
+        self.verbose = verbose
+
+        self.session = requests.Session()
+        # vlbimon session state lives in explicit cookies, don't let the jar accumulate it
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        if verbose > 1:
+            print('http client for', server, 'pool size', pool_maxsize, 'timeouts', self.timeout, 'rate', rate)
+            print('json decoder', decode.backend, 'streaming' if stream else '')
+
+    def request(self, method, query, **kwargs):
+        if self.limiter:
+            self.limiter.wait()
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, self.server + query, **kwargs)
+
+    def get(self, query, **kwargs):
+        return self.request('GET', query, **kwargs)
+
+    def post(self, query, **kwargs):
+        return self.request('POST', query, **kwargs)
+
+    def patch(self, query, **kwargs):
+        return self.request('PATCH', query, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_client(cmd, pool_maxsize=4, rate=None, verbose=0):
+    '''Create the HTTPClient selected by the command line flags.'''
+    server, auth = get_server(cmd.two, secrets=cmd.secrets, verbose=verbose)
+    return HTTPClient(server, auth=auth, pool_maxsize=pool_maxsize,
+                      connect_timeout=cmd.connect_timeout, read_timeout=cmd.read_timeout, rate=rate,
+                      stream=cmd.stream, verbose=verbose)
+
+
+def get_clients(cmd, pool_maxsize=4, rate=None, verbose=0):
+    '''Create an HTTPClient for each server selected by the command line flags. -1 -2 selects both.'''
+    twos = (False, True) if cmd.one and cmd.two else (cmd.two,)
+    clients = []
+    for two in twos:
+        server, auth = get_server(two, secrets=cmd.secrets, verbose=verbose)
+        clients.append(HTTPClient(server, auth=auth, pool_maxsize=pool_maxsize,
+                                  connect_timeout=cmd.connect_timeout, read_timeout=cmd.read_timeout,
+                                  rate=rate, stream=cmd.stream, verbose=verbose))
+    return clients
+
+
+def get_history(http, datafields, observatories, start_timestamp, end_timestamp, verbose=0):
     query = '/data/history'
 
     params = {
@@ -65,11 +279,22 @@ def get_history(server, datafields, observatories, start_timestamp, end_timestam
         'endTime': int(end_timestamp),
     }
     if verbose > 1:
-        print('requesting history, server:', server, 'param:', params)
-    resp = requests.get(server + query, params=params, auth=auth)
+        print('requesting history, server:', http.server, 'param:', params)
+    http.retry.wait()
+    try:
+        resp = http.get(query, params=params, auth=http.auth, stream=http.stream)
+    except requests.exceptions.RequestException as e:
+        print('whoops! field {} raised {}'.format(datafields, repr(e)))
+        http.retry.failure()
+        return None
     if resp.status_code != 200:
         print('whoops! field {} returned {} and:\n'.format(datafields, resp.status_code))
         print('  text is', resp.text)
+        if resp.status_code == 429 or resp.status_code >= 500:
+            http.retry.failure(retry_after=retry_after(resp))
+        else:
+            # a 4xx is about this request, not about the server
+            http.retry.release()
         return None
 
     # what users expect:
@@ -77,45 +302,64 @@ def get_history(server, datafields, observatories, start_timestamp, end_timestam
     # empty dict is no returned points in this timespan
     # dict with points is a valid result
 
+    if http.stream:
+        j = {}
+        try:
+            for station, param, t, value in decode.iter_history(decode.response_stream(resp)):
+                j.setdefault(station, {}).setdefault(param, []).append([t, value])
+        except Exception as e:
+            print('whoops! failed streaming json decode of', repr(e))
+            http.retry.failure()
+            return None
+        finally:
+            resp.close()
+        http.retry.success()
+        return j
+
     try:
-        j = resp.json()
+        j = decode.response_json(resp)
     except Exception as e:
         print('whoops! failed json decode of', repr(e))
         print('  text is', resp.text)
+        http.retry.failure()
         return None
 
+    http.retry.success()
     return j
 
 
-def create_session(server, auth):
+def create_session(http):
     query = '/session'
     while True:
+        http.retry.wait()
+        r = None
         try:
-            r = requests.post(server + query, auth=auth)
+            r = http.post(query, auth=http.auth)
             r.raise_for_status()
         except Exception as e:
-            print('saw exception', repr(e), 'looping')
-            time.sleep(10)
+            delay = http.retry.failure(retry_after=retry_after(r))
+            print('saw exception', repr(e), 'retrying in', round(delay, 1), 'seconds')
             continue
         try:
-            j = r.json()
-        except json.JSONDecodeError as e:
-            print('saw exception', repr(e), 'looping')
-            time.sleep(10)
+            j = decode.response_json(r)
+        except decode.decode_errors as e:
+            delay = http.retry.failure()
+            print('saw exception', repr(e), 'retrying in', round(delay, 1), 'seconds')
             continue
         if 'id' in j:
             break
-        print('did not see a session id in the return, even though no exceptions were thrown. looping.')
-        time.sleep(10)
+        delay = http.retry.failure()
+        print('did not see a session id in the return, even though no exceptions were thrown. retrying in', round(delay, 1), 'seconds')
+    http.retry.success()
     return j['id']
 
 
-def restore_session(server, sessionid, auth):
+def restore_session(http, sessionid):
     if sessionid is None:
         raise FileNotFoundError('no sessionid')
     query = '/session/' + sessionid
 
-    r = requests.patch(server + query, auth=auth)
+    r = http.patch(query, auth=http.auth)
     if r.status_code == 404:
         raise FileNotFoundError('sessionid has expired')
     if not r.ok:
@@ -124,21 +368,23 @@ def restore_session(server, sessionid, auth):
     return sessionid
 
 
-def get_sessionid(server, sessionid=None, auth=None, verbose=0):
+def get_sessionid(http, sessionid=None, verbose=0):
     try:
         if verbose:
             print('attempting to restore session')
-        return restore_session(server, sessionid, auth)
+        return restore_session(http, sessionid)
     except FileNotFoundError:
         if verbose:
             print('creating a new session after restore did not work')
-        return create_session(server, auth)
+        return create_session(http)
     except Exception as e:
         print('restore_session got', repr(e), ', creating a new session')
-        return create_session(server, auth)
+        return create_session(http)
 
 
-def get_snapshot(server, last_snap=None, sessionid=None, auth=None, verbose=0):
+def get_snapshot(http, last_snap=None, sessionid=None, renew=True, verbose=0):
+    '''Returns (sessionid, last_snap, snapshot). If renew is False, an expired
+    session is returned as sessionid None and it is up to the caller to get a new one.'''
     query = '/data/snapshot'
 
     if last_snap is not None:
@@ -148,35 +394,64 @@ def get_snapshot(server, last_snap=None, sessionid=None, auth=None, verbose=0):
     cookies['sessionid'] = sessionid
 
     if verbose > 1:
-            print('getting snapshot from server', server, 'last snapshot was', last_snap)
+            print('getting snapshot from server', http.server, 'last snapshot was', last_snap)
+
+    delay = http.retry.delay()
+    if delay > 0:
+        # backing off, or the circuit is open: don't even ask
+        if verbose:
+            print('not polling', http.server, 'for another', round(delay, 1), 'seconds')
+        return sessionid, last_snap, {}
 
     try:
-        r = requests.get(server + query, cookies=cookies)
+        r = http.get(query, cookies=cookies, stream=http.stream)
     except Exception as e:
-        print('something bad happened ({}). sleeping for 10s.'.format(repr(e)))
+        delay = http.retry.failure()
+        print('something bad happened ({}). backing off for {}s.'.format(repr(e), round(delay, 1)))
         return sessionid, last_snap, {}
 
     if verbose > 1:
         print('got a snapshot, status_code is', r.status_code)
+    if http.stream and not r.ok:
+        r.close()  # nothing to stream, give back the connection
     if r.status_code in (401, 403):
         # example: requests.exceptions.HTTPError: 401 Client Error: Unauthorized for url: https://vlbimon2.science.ru.nl/data/snapshot
+        http.retry.release()
+        if not renew:
+            print('session expired, status', r.status_code)
+            return None, last_snap, {}
         print('fetching a new session id after getting a', r.status_code)
-        sessionid = get_sessionid(server, auth=auth)
+        sessionid = get_sessionid(http)
         return sessionid, last_snap, {}
     if r.status_code in (429, 503):
         # slow down and service unavailable
-        print('slow down', r.status_code, 'sleeping for 10sec')
+        delay = http.retry.failure(retry_after=retry_after(r))
+        print('slow down', r.status_code, 'backing off for {}s'.format(round(delay, 1)))
         return sessionid, last_snap, {}
     if not r.ok:
-        print('saw status_code', r.status_code, 'sleeping for 10sec')
+        delay = http.retry.failure()
+        print('saw status_code', r.status_code, 'backing off for {}s'.format(round(delay, 1)))
         return sessionid, last_snap, {}
 
-    try:
-        snapshot = r.json()
-    except json.JSONDecodeError as e:
-        print('whoops! failed json decode of', repr(e))
-        print('  text is', r.text)
-        return sessionid, last_snap, {}
+    if http.stream:
+        # flat records instead of the nested dict, utils.flatten takes either
+        try:
+            snapshot = list(decode.iter_snapshot(decode.response_stream(r)))
+        except Exception as e:
+            delay = http.retry.failure()
+            print('whoops! failed streaming json decode of', repr(e))
+            return sessionid, last_snap, {}
+        finally:
+            r.close()
+    else:
+        try:
+            snapshot = decode.response_json(r)
+        except decode.decode_errors as e:
+            delay = http.retry.failure()
+            print('whoops! failed json decode of', repr(e))
+            print('  text is', r.text)
+            return sessionid, last_snap, {}
 
+    http.retry.success()
     last_snap = r.cookies.get('snap_recvTime')
     return sessionid, last_snap, snapshot
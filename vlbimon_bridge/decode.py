@@ -0,0 +1,96 @@
+'''
+Decoding vlbimon's json responses.
+
+loads() uses orjson or ujson if one is installed, else the stdlib json.
+With ijson installed, the iter_ functions decode a response incrementally,
+straight from the response stream, without holding the whole body.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+if orjson:
+    backend = 'orjson'
+    loads = orjson.loads
+elif ujson:
+    backend = 'ujson'
+    loads = ujson.loads
+else:
+    backend = 'json'
+    loads = json.loads
+
+# all of the backends raise subclasses of ValueError on bad json
+decode_errors = (ValueError, ijson.JSONError) if ijson else (ValueError,)
+
+
+def check_streaming():
+    if ijson is None:
+        raise ValueError('streaming json decoding needs ijson, pip install ijson')
+
+
+def response_json(resp):
+    return loads(resp.content)
+
+
+def response_stream(resp):
+    # let urllib3 undo any gzip, ijson wants the json itself
+    resp.raw.decode_content = True
+    return resp.raw
+
+
+def iter_points(fp, is_point):
+    '''Yield (prefix, point) for the arrays whose ijson prefix passes is_point.'''
+    check_streaming()
+    builder = None
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if builder is None:
+            if event == 'start_array' and is_point(prefix):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                point_prefix = prefix
+        else:
+            builder.event(event, value)
+            if event == 'end_array' and prefix == point_prefix:
+                yield prefix, builder.value
+                builder = None
+
+
+def is_snapshot_point(prefix):
+    parts = prefix.split('.')
+    return len(parts) == 3 and parts[1] == 'data' and parts[0] != 'vexfiles'
+
+
+def iter_snapshot(fp, to_int=True):
+    '''Yield flat [station, param, time, value] records from a snapshot, like utils.flatten without add_points.
+
+    The snapshot looks like {station: {'data': {param: [time, value]}}, 'vexfiles': ...}'''
+    for prefix, point in iter_points(fp, is_snapshot_point):
+        station, _, param = prefix.split('.')
+        recvTime = int(point[0]) if to_int else point[0]
+        yield [station, param, recvTime, point[1]]
+
+
+def is_history_point(prefix):
+    parts = prefix.split('.')
+    return len(parts) == 3 and parts[2] == 'item'
+
+
+def iter_history(fp):
+    '''Yield flat [station, param, time, value] records from a history response.
+
+    The history looks like {station: {param: [[time, value], ...]}}'''
+    for prefix, point in iter_points(fp, is_history_point):
+        station, param, _ = prefix.split('.')
+        yield [station, param, point[0], point[1]]
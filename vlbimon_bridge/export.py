@@ -0,0 +1,225 @@
+'''
+Exporting ts_param_ tables from a sqlite database to csv, gzip'd csv, or parquet.
+
+Rows are streamed from the database in batches of --batch rows, so
+memory use does not depend on the size of the table.
+'''
+
+import csv
+import gzip
+import os
+import os.path
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlite3
+
+from . import partition
+from . import sqlite
+from . import utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+TIMESTAMP = '%Y%m%d%H%M%S'
+
+formats = ('csv', 'csv.gz', 'parquet')
+
+to_arrow_types = {
+    'INTEGER': 'int64',
+    'BOOLEAN': 'int64',  # stored as 0 and 1
+    'REAL': 'float64',
+    'TEXT': 'string',
+}
+
+
+def get_params(con, params=None, match=None):
+    '''Return the params of the ts_param_ tables and views, optionally restricted to exact names or substrings.'''
+    # partition.connect() makes TEMP views
+    cur = con.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name LIKE 'ts_param_%' "
+                      "UNION SELECT name FROM sqlite_temp_master WHERE type = 'view' AND name LIKE 'ts_param_%'")
+    ret = []
+    for name, in cur.fetchall():
+        param = name.replace('ts_param_', '', 1)
+        if param == 'schedule':
+            # unusual schema
+            continue
+        if params and param not in params:
+            continue
+        if match and not any(m in param for m in match):
+            continue
+        ret.append(param)
+    return sorted(ret)
+
+
+def get_types(con, params, verbose=0):
+    '''Return a dict of param: sql type, for parquet.
+
+    The type comes from the database: the declared type of the value column, the
+    params table of the points layout, or else the type of a value. Only a param that
+    has none of these needs the types from masterlist.json and vlbimon_types.csv.'''
+    declared = {}
+    try:
+        # points layout, where the views' value column has no declared type
+        declared = dict(con.execute('SELECT name, type FROM params'))
+    except sqlite3.OperationalError:
+        pass
+
+    ret = {}
+    unknown = []
+    for param in params:
+        table = 'ts_param_' + param
+        row = con.execute("SELECT type FROM pragma_table_info(?) WHERE name = 'value'", (table,)).fetchone()
+        sql_type = row[0].upper() if row else ''
+        if sql_type not in to_arrow_types:
+            sql_type = declared.get(param)
+        if sql_type not in to_arrow_types:
+            row = con.execute('SELECT typeof(value) FROM {} WHERE value IS NOT NULL LIMIT 1'.format(table)).fetchone()
+            if row is None:
+                # no values, nothing will be exported
+                ret[param] = None
+                continue
+            sql_type = row[0].upper()
+        if sql_type in to_arrow_types:
+            ret[param] = sql_type
+        else:
+            unknown.append(param)
+
+    if unknown:
+        types = sqlite.timeseries_types(verbose=verbose)
+        for param in unknown:
+            ret[param] = types.get(param)
+    return ret
+
+
+def iter_batches(cur, batch, stop):
+    while True:
+        if stop.is_set():
+            raise RuntimeError('export stopped')
+        rows = cur.fetchmany(batch)
+        if not rows:
+            break
+        yield rows
+
+
+def write_csv(fd, batches):
+    count = 0
+    csv_writer = csv.writer(fd)
+    csv_writer.writerow(('time', 'timestamp', 'station', 'value'))
+    for rows in batches:
+        csv_writer.writerows((t, time.strftime(TIMESTAMP, time.gmtime(t)), station, value) for t, station, value in rows)
+        count += len(rows)
+    return count
+
+
+def write_parquet(fname, batches, sql_type):
+    schema = pyarrow.schema([
+        ('time', pyarrow.int64()),
+        ('station', pyarrow.string()),
+        ('value', pyarrow.type_for_alias(to_arrow_types.get(sql_type, 'string'))),
+    ])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(fname, schema) as writer:
+        # one row group per batch
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+            count += len(rows)
+    return count
+
+
+def connect(cmd):
+    if cmd.partitions:
+        return partition.connect(cmd.sqlitedb, start=cmd.start, end=cmd.end)
+    return sqlite3.connect('file:{}?mode=ro'.format(cmd.sqlitedb), uri=True)
+
+
+def export_one(cmd, param, sql_type, stop):
+    '''Export one param, each job with its own read-only connection so that jobs run concurrently.'''
+    if stop.is_set():
+        return 0
+    suffix = '.' + cmd.format
+    fname = os.path.join(cmd.datadir, param + suffix)
+    tmp = fname + '.tmp'
+
+    con = connect(cmd)
+    try:
+        cur = sqlite.query_timeseries(con, param, stations=cmd.stations, start=cmd.start, end=cmd.end)
+        batches = iter_batches(cur, cmd.batch, stop)
+        if cmd.format == 'parquet':
+            count = write_parquet(tmp, batches, sql_type)
+        elif cmd.format == 'csv.gz':
+            with gzip.open(tmp, 'wt', newline='') as fd:
+                count = write_csv(fd, batches)
+        else:
+            with open(tmp, 'w', newline='') as fd:
+                count = write_csv(fd, batches)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        con.close()
+
+    if count:
+        os.replace(tmp, fname)
+    else:
+        os.remove(tmp)
+    if cmd.verbose:
+        print('exported', count, 'rows of', param, file=sys.stderr)
+    return count
+
+
+def export(cmd):
+    verbose = cmd.verbose
+    sqlitedb = cmd.sqlitedb
+
+    if cmd.format == 'parquet' and pyarrow is None:
+        raise ValueError('--format parquet needs pyarrow, pip install pyarrow')
+    if not cmd.partitions:
+        if not os.path.isfile(sqlitedb):
+            raise ValueError('database file {} does not exist'.format(sqlitedb))
+        utils.checkout_db(sqlitedb, mode='r')
+    os.makedirs(cmd.datadir, exist_ok=True)
+
+    con = connect(cmd)
+    params = get_params(con, params=cmd.param, match=cmd.match)
+    types = get_types(con, params, verbose=verbose) if cmd.format == 'parquet' else {}
+    con.close()
+
+    if verbose:
+        print('exporting', len(params), 'params with', cmd.workers, 'workers', file=sys.stderr)
+
+    t0 = time.time()
+    stop = threading.Event()
+    total = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=cmd.workers) as executor:
+        futures = [executor.submit(export_one, cmd, param, types.get(param), stop) for param in params]
+        try:
+            for future, param in zip(futures, params):
+                try:
+                    total += future.result()
+                except Exception:
+                    failed += 1
+                    print('whoops! export of {} failed:'.format(param))
+                    traceback.print_exc()
+        except KeyboardInterrupt:
+            print('^C seen, stopping the exports in flight')
+            stop.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.time() - t0
+    print('exported {} rows in {} seconds'.format(total, round(elapsed, 1)), file=sys.stderr)
+    if failed:
+        print(failed, 'of', len(params), 'exports failed')
@@ -1,6 +1,9 @@
-import time
 import os
 import os.path
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from . import client
 from . import utils
@@ -24,94 +27,207 @@ def select_cadence(cmd, value):
     return int(cadence)
 
 
+class WindowPlanner:
+    '''Sizes the history windows of one (station, param) from its observed point density.
+
+    density is in points per second. It starts from what an earlier run saved in
+    metadata.json, or else from the masterlist cadence, and is updated from every
+    response. Each window is sized to return about target points.'''
+
+    def __init__(self, cadence, density=None, target=500, min_window=60, max_window=7*86400, slow=20.):
+        self.target = target
+        self.min_window = min_window
+        self.max_window = max_window
+        self.slow = slow
+        self.density = density or 1. / cadence
+        self.window = self.clip(target / self.density)
+
+    def clip(self, window):
+        return int(min(self.max_window, max(self.min_window, window)))
+
+    def observe(self, window, npoints, elapsed):
+        '''Learn from a successful response of npoints points covering window seconds.'''
+        if npoints == 0:
+            # all we learned is an upper bound. grow, but not so fast that we land
+            # a huge window on top of the next dense stretch of data
+            self.density = min(self.density, 1. / window)
+            self.window = self.clip(window * 4)
+            return
+
+        measured = npoints / window
+        if npoints > 2 * self.target:
+            # too big: believe the measurement completely
+            self.density = measured
+        else:
+            self.density = 0.5 * self.density + 0.5 * measured
+        new_window = self.target / self.density
+        if elapsed > self.slow:
+            new_window = min(new_window, window / 2)
+        self.window = self.clip(min(new_window, window * 4))
+
+    def failed(self, window):
+        '''A failed request might have been too big, retry with a smaller window.'''
+        self.window = self.clip(window / 2)
+
+
 def history(cmd):
     verbose = cmd.verbose
     datadir = cmd.datadir.rstrip('/')
-    secrets = cmd.secrets
 
-    server, auth = client.get_server(cmd.two, secrets=secrets, verbose=verbose)
+    http = client.get_client(cmd, pool_maxsize=cmd.workers, rate=cmd.rate, verbose=verbose)
 
     stations, parameters = utils.read_masterlist()
     utils.comment_on_masterlist(stations, parameters, verbose=verbose)
-    metadata = utils.read_metadata(stations, metadir=datadir)
 
     stations = cmd.stations or stations
+    metadata = utils.MetadataStore(stations, metadir=datadir, verbose=verbose)
+
+    if cmd.end is None:
+        cmd.end = int(time.time())
+    if cmd.start is None and not cmd.resume:
+        raise ValueError('--start is required unless --resume is given')
 
+    # one job per (station, param). each job walks its time windows in order,
+    # so the csv appends stay monotonic, while the jobs run concurrently
+    jobs = []
     for station in stations:
-        if verbose:
-            print(station+':')
         for param, value in parameters.items():
             if cmd.param and param not in cmd.param:
                 continue
-            metadata = utils.read_metadata(stations, station=station, metadir=datadir, verbose=verbose)
-            dirname = datadir + '/' + station
-            os.makedirs(dirname, exist_ok=True)
-            fout = dirname + '/' + param + '.csv'
-
             cadence = select_cadence(cmd, value)
             if cadence is None:
                 continue
+            jobs.append((station, param, cadence))
+
+    if verbose:
+        print('backfilling', len(jobs), 'station params with', cmd.workers, 'workers at', cmd.rate, 'requests/second')
+
+    stop = threading.Event()
+    failed = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=cmd.workers) as executor:
+            futures = [executor.submit(backfill_one, cmd, http, station, param, cadence, metadata, stop)
+                       for station, param, cadence in jobs]
+            try:
+                for future, job in zip(futures, jobs):
+                    try:
+                        future.result()
+                    except Exception:
+                        failed += 1
+                        print('whoops! backfill of {} {} failed:'.format(*job[:2]))
+                        traceback.print_exc()
+            except KeyboardInterrupt:
+                print('^C seen, finishing the windows in flight')
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        # after the executor has waited for the windows in flight
+        http.close()
+        metadata.close()
+
+    if failed:
+        print(failed, 'of', len(jobs), 'backfills failed')
+
+
+def backfill_one(cmd, http, station, param, cadence, metadata, stop):
+    verbose = cmd.verbose
+    datadir = cmd.datadir.rstrip('/')
+
+    dirname = datadir + '/' + station
+    os.makedirs(dirname, exist_ok=True)
+    fout = dirname + '/' + param + '.csv'
+
+    if verbose:
+        print(fout+':')
+
+    density = metadata.get(station, param, 'density')
+    last_tried = metadata.get(station, param, 'last_tried')
+    planner = WindowPlanner(cadence, density=density, target=cmd.target_points)
+
+    tee = cmd.start
+    if cmd.resume and last_tried is not None:
+        # everything before last_tried is already in the csv
+        tee = max(tee or 0, last_tried)
+    if tee is None:
+        print('no --start and nothing to resume for {} {}, skipping'.format(station, param))
+        return
+    if verbose and tee != cmd.start:
+        print('resuming {} {} at {}'.format(station, param, tee))
+
+    # an interrupted run might have written the csv but not the metadata
+    last_written = utils.csv_repair_tail(fout)
+    if not cmd.resume and last_written is not None and tee <= last_written:
+        # only points after last_written can be appended, the rest would be silently dropped
+        print('whoops: {} already has points up to {}, after --start {}. skipping {} {}; use --resume to top it up, '
+              'or a different --datadir for earlier data'.format(fout, last_written, tee, station, param))
+        return
+    retries = 0
+    while tee < cmd.end:
+        if stop.is_set():
+            return
+        ts = tee
+        te = min(cmd.end, ts + planner.window)
+        t0 = time.time()
+        resp_json = client.get_history(http, param, station, ts, te, verbose=verbose)
+        elapsed = time.time() - t0
+
+        # None = error, nothing learned
+        # {} = valid but no data for interval. update metadata and last_tried
+        # valid data... update both last_tried and last_seen
+
+        if resp_json is None:
+            planner.failed(te - ts)
+            retries += 1
+            if retries <= 3:
+                continue
+            # stop here instead of skipping the window: last_tried stays before it, so --resume retries it
+            print('giving up on {} {} from {} to {}, --resume will start there'.format(station, param, ts, te))
+            return
+        tee = te
+        retries = 0
+
+        points = resp_json.get(station, {}).get(param, [])
+        # there's a bug where we get a single point before "start"
+        # with every single query, don't count it
+        npoints = len([p for p in points if p[0] >= ts])
+        planner.observe(te - ts, npoints, elapsed)
+        if verbose > 1:
+            print('{} {} got {} points in {}s, next window is {}s'.format(station, param, npoints, te - ts, planner.window))
+
+        # drop the point-before-start bug, overlaps with the previous
+        # window, and whatever an interrupted run already wrote
+        if last_written is not None:
+            points = [p for p in points if p[0] > last_written]
+
+        if len(points) == 0:
+            metadata.update(station, param, last_tried=max(te, last_tried or 0), density=planner.density)
+            continue
+
+        utils.debug_cadence(points, station=station, param=param, verbose=verbose)
+        last_seen = points[-1][0]
+        if last_seen > te:
+            print('whoops. got a point for {} {} in the future'.format(station, param))
+        if last_seen == 946684800:  # yes, it's an int: 'Sat Jan  1 00:00:00 UTC 2000'
+            print('whoops: 2000 BUG seen, backing up one')
+            points.pop()
+            try:
+                last_seen = points[-1][0]  # may crash
+            except Exception:
+                last_seen = None
+
+        lines = []
+        for t, v in points:
+            if isinstance(v, str):
+                v = v.strip()
+            lines.append('{},{}\n'.format(t, v))
+        if lines:
+            utils.csv_append(fout, lines)
+            last_written = points[-1][0]
+
+        # the metadata is written after the csv, so it never claims more than the csv has
+        # never move last_tried backwards, --resume skips everything before it
+        metadata.update(station, param, last_tried=max(te, last_tried or 0), last_seen=last_seen, density=planner.density)
 
-            if verbose:
-                print(fout+':')
-
-            cadence *= 100
-            orig_cadence = cadence
-
-            # note that this loop ignores last_tried and last_seen
-            tee = cmd.start
-            while tee < cmd.end:
-                ts = tee
-                tee += cadence
-                te = min(cmd.end, ts + cadence)
-                resp_json = client.get_history(server, param, station, ts, te, auth=auth, verbose=verbose)
-
-                # None = error, nothing learned
-                # {} = valid but no data for interval. update metadata and last_tried
-                # valid data... update both last_tried and last_seen
-
-                if resp_json is None:
-                    cadence *= 1.5
-                    cadence = int(cadence)
-                    continue
-
-                if param not in metadata[station]:
-                    metadata[station][param] = {}
-
-                metadata[station][param]['last_tried'] = te
-                if len(resp_json) == 0:
-                    cadence *= 1.5
-                    cadence = int(cadence)
-                    continue
-
-                if len(resp_json) > 5:
-                    # there's a bug where we get a single point before "start"
-                    # with every single query
-                    # don't adjust the cadence unless we got a lot of points
-                    cadence = orig_cadence
-
-                points = resp_json[station][param]
-                utils.debug_cadence(points, station=station, param=param, verbose=verbose)
-                if len(resp_json) > 0:
-                    last_seen = points[-1][0]
-                    if last_seen > te:
-                        print('whoops. got a point for {} {} in the future'.format(station, param))
-                    if last_seen == 946684800:  # yes, it's an int: 'Sat Jan  1 00:00:00 UTC 2000'
-                        print('whoops: 2000 BUG seen, backing up one')
-                        points.pop()
-                        try:
-                            last_seen = points[-1][0]  # may crash
-                        except Exception:
-                            last_seen = None
-                    if last_seen is not None:
-                        metadata[station][param]['last_seen'] = last_seen
-
-                with open(fout, 'a') as fd:
-                    for t, v in points:
-                        if isinstance(v, str):
-                            v = v.strip()
-                        print('{},{}'.format(t, v), file=fd)
-
-                utils.write_metadata(metadata, station=station, metadir=datadir, verbose=verbose)
-
-                time.sleep(1)
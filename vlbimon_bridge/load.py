@@ -0,0 +1,151 @@
+import os
+import os.path
+import sys
+import time
+
+import sqlite3
+
+from . import sqlite
+from . import transformer
+from . import utils
+
+
+def convert_value(value, sql_type):
+    '''Turn the text of a history csv value back into what the bridge would insert.'''
+    if sql_type == 'TEXT':
+        return value
+    if value in ('', 'None', 'null'):
+        return None
+    if sql_type == 'BOOLEAN':
+        if value in ('True', 'true', '1'):
+            return 1
+        if value in ('False', 'false', '0'):
+            return 0
+        raise ValueError('not a boolean: '+value)
+    if sql_type == 'INTEGER':
+        return int(float(value))
+    return float(value)
+
+
+def read_csv(fname, station, param, batch):
+    '''Yield utils.Batch objects of up to batch points from a history csv file, skipping bad lines.'''
+    tables = utils.Batch()
+    rows = tables[param]
+    with open(fname) as fd:
+        for lineno, line in enumerate(fd, 1):
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            try:
+                t, value = line.split(',', 1)  # strings might contain commas
+                rows.append((int(t), station, value))
+            except ValueError as e:
+                print('{}:{}: skipping bad line {!r}: {!r}'.format(fname, lineno, line[:80], e), file=sys.stderr)
+                continue
+            if len(rows) >= batch:
+                yield tables
+                tables = utils.Batch()
+                rows = tables[param]
+    if rows:
+        yield tables
+
+
+def insert_tables(cur, tables, types, layouts, verbose=0):
+    rows = 0
+    for param, data in tables.items():
+        sql_type = types.get(param)
+        if sql_type is None:
+            if verbose:
+                print('skipping', len(data), 'points for unknown table', param, file=sys.stderr)
+            continue
+        converted = []
+        for recv_time, station, value in data:
+            try:
+                converted.append((recv_time, station, convert_value(value, sql_type)))
+            except ValueError as e:
+                if verbose:
+                    print('skipping', param, station, recv_time, repr(e), file=sys.stderr)
+        table = 'ts_param_' + param
+        layout = layouts.get(table, 'rowid')
+        insert_rows = converted
+        if layout in ('points', 'points_strings'):
+            insert_rows = sqlite.points_rows(cur.connection, cur, param, converted, intern=(layout == 'points_strings'))
+        cur.executemany(sqlite.insert_sql(table, layout), insert_rows)
+        sqlite.insert_rollups(cur.connection, cur, param, converted, verbose=verbose)
+        rows += len(converted)
+    return rows
+
+
+def load(cmd):
+    verbose = cmd.verbose
+    datadir = cmd.datadir.rstrip('/')
+    sqlitedb = cmd.sqlitedb
+
+    if not os.path.isfile(sqlitedb):
+        raise ValueError('database file {} does not exist'.format(sqlitedb))
+    utils.checkout_db(sqlitedb, mode='w')
+
+    types = sqlite.timeseries_types(verbose=verbose)
+    stations = cmd.stations or sorted(d for d in os.listdir(datadir) if os.path.isdir(datadir + '/' + d))
+
+    con = sqlite3.connect(sqlitedb, factory=sqlite.Connection)
+    cur = con.cursor()
+    # this is a bulk load into a database nobody else is using: if it crashes, start over.
+    # not OFF, because a file that fails to load is rolled back
+    cur.execute('PRAGMA journal_mode=MEMORY')
+    cur.execute('PRAGMA synchronous=OFF')
+    cur.execute('PRAGMA cache_size=-{}'.format(256 * 1024))  # KiB
+
+    if verbose:
+        print('dropping indexes until the load is finished', file=sys.stderr)
+    index_sqls = []
+    for param in types:
+        index_sqls.extend(sqlite.drop_indexes(cur, 'ts_param_'+param, verbose=verbose))
+    con.commit()
+
+    t0 = time.time()
+    total = 0
+    failed = []
+    try:
+        for station in stations:
+            dirname = datadir + '/' + station
+            if not os.path.isdir(dirname):
+                print('no directory for station', station, file=sys.stderr)
+                continue
+            rows = 0
+            for fname in sorted(os.listdir(dirname)):
+                if not fname.endswith('.csv'):
+                    continue
+                param = fname[:-len('.csv')]
+                if cmd.param and param not in cmd.param:
+                    continue
+                path = dirname + '/' + fname
+                file_rows = 0
+                try:
+                    for tables in read_csv(path, station, param, cmd.batch):
+                        transformer.transform(tables, verbose=verbose, dedup_events=True)
+                        file_rows += insert_tables(cur, tables, types, sqlite.get_layouts(con), verbose=verbose)
+                    con.commit()
+                except (sqlite3.Error, ValueError, OverflowError) as e:
+                    # one file at a time, so that one bad file does not cost the rest of the load
+                    con.rollback()
+                    sqlite.forget_schema(con)
+                    print('whoops! skipping {}, nothing from it was loaded: {!r}'.format(path, e), file=sys.stderr)
+                    failed.append(path)
+                    continue
+                rows += file_rows
+            total += rows
+            if verbose:
+                print('loaded', rows, 'rows for', station, file=sys.stderr)
+    finally:
+        if verbose:
+            print('recreating', len(index_sqls), 'indexes', file=sys.stderr)
+        sqlite.restore_indexes(cur, index_sqls, verbose=verbose)
+        con.commit()
+        cur.close()
+        con.close()
+
+    elapsed = time.time() - t0
+    print('loaded {} rows in {} seconds'.format(total, round(elapsed, 1)), file=sys.stderr)
+    if failed:
+        print(len(failed), 'files failed to load:', *failed, file=sys.stderr)
@@ -1,5 +1,9 @@
+import contextlib
 import sqlite3
 
+from . import sqlite
+from . import transformer
+
 
 def parse_argv(argv):
     if len(argv) == 3:
@@ -69,6 +73,28 @@ def check_old_new(names, table_renames, new_tables, prefix='ts_param_'):
     return old_count, new_count
 
 
+def connect_manual(db):
+    '''Connect with the sqlite3 module's implicit transactions turned off, for use with transaction().'''
+    con = sqlite3.connect(db, isolation_level=None)
+    con.execute('PRAGMA busy_timeout=10000')
+    return con
+
+
+@contextlib.contextmanager
+def transaction(con):
+    '''BEGIN IMMEDIATE ... COMMIT, or ROLLBACK on any error.
+
+    Without an explicit BEGIN, the sqlite3 module runs DDL such as DROP INDEX
+    in autocommit mode, and a failure part way through cannot be rolled back.'''
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        con.execute('ROLLBACK')
+        raise
+    con.execute('COMMIT')
+
+
 def do_table_renames(db, renames, prefix='ts_param_'):
     con = sqlite3.connect(db)
     cur = con.cursor()
@@ -76,33 +102,159 @@ def do_table_renames(db, renames, prefix='ts_param_'):
         old = prefix+old
         new = prefix+new
 
-        cur.execute('ALTER TABLE {} RENAME TO {}'.format(old, new))
+        index = sqlite.get_index_mode(cur, old)
 
         # drop the old index
-        cur.execute('DROP INDEX idx_{}_time'.format(old))
-        cur.execute('DROP INDEX idx_{}_station'.format(old))
+        sqlite.drop_indexes(cur, old)
+
+        cur.execute('ALTER TABLE {} RENAME TO {}'.format(old, new))
 
         # add a new index
-        cur.execute('CREATE INDEX idx_{}_time ON {}(time)'.format(new, new))
-        cur.execute('CREATE INDEX idx_{}_station ON {}(station)'.format(new, new))
+        if index is not None:
+            sqlite.create_indexes(cur, new, index=index)
     cur.close()
     con.commit()
     con.close()
 
 
-def do_new_tables(db, new_tables, prefix='ts_param_'):
+def do_new_tables(db, new_tables, prefix='ts_param_', vlbi_type='REAL'):
     con = sqlite3.connect(db)
     cur = con.cursor()
+    index = sqlite.get_db_index_mode(cur)
+    layout = sqlite.get_db_layout(cur)
+    if layout.startswith('points') and prefix != 'ts_param_':
+        raise ValueError('the points layout only has ts_param_ timeseries')
     for new in new_tables:
-        new = prefix+new
-        cur.execute('CREATE TABLE {} (time INTEGER NOT NULL, station TEXT NOT NULL, value {})'.format(new, 'REAL'))
-        cur.execute('CREATE INDEX idx_{}_time ON {}(time)'.format(new, new))
-        cur.execute('CREATE INDEX idx_{}_station ON {}(station)'.format(new, new))
+        if prefix == 'ts_param_':
+            sqlite.add_timeseries(cur, new, vlbi_type, index=index, layout=layout)
+        else:
+            new = prefix+new
+            cur.execute(sqlite.timeseries_sql(new, vlbi_type, layout=layout))
+            if layout == 'rowid':
+                sqlite.create_indexes(cur, new, index=index)
     cur.close()
     con.commit()
     con.close()
 
 
+def get_index_modes(db, prefix='ts_param_'):
+    '''Return a dict of table: index mode for the timeseries tables.'''
+    con = sqlite3.connect(db)
+    cur = con.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?", (prefix+'%',))
+    tables = [r[0] for r in cur.fetchall()]
+    modes = dict((t, sqlite.get_index_mode(cur, t)) for t in tables if t != 'ts_param_schedule')
+    cur.close()
+    con.close()
+    return modes
+
+
+def do_convert_indexes(db, index, tables, verbose=1):
+    '''Replace the indexes on tables, one transaction per table, so an interrupted conversion
+    leaves each table with either its old or its new indexes. Each transaction holds the write
+    lock while the indexes are built, much longer than the bridge's busy timeout.'''
+    con = connect_manual(db)
+    cur = con.cursor()
+    for table in tables:
+        if verbose:
+            print(' ', table)
+        with transaction(con):
+            sqlite.set_indexes(cur, table, index=index)
+    cur.close()
+    con.close()
+
+
+def get_layouts(db):
+    con = sqlite3.connect(db)
+    layouts = sqlite.get_layouts(con)
+    layouts.pop('ts_param_schedule', None)
+    con.close()
+    return layouts
+
+
+def do_convert_layout(db, tables, layout, verbose=1):
+    '''Rebuild tables in a new layout, one transaction per table, so an interrupted conversion
+    leaves each table in either its old or its new layout. Each transaction holds the write lock
+    while the table is copied, much longer than the bridge's busy timeout.'''
+    con = connect_manual(db)
+    cur = con.cursor()
+    for table in tables:
+        if verbose:
+            print(' ', table)
+        with transaction(con):
+            convert_layout(cur, table, layout)
+    cur.close()
+    con.close()
+
+
+def convert_layout(cur, table, layout):
+    cur.execute("SELECT type FROM pragma_table_info(?) WHERE name = 'value'", (table,))
+    vlbi_type = cur.fetchone()[0]
+    if layout == 'points':
+        convert_to_points(cur, table, vlbi_type)
+        return
+    new = table + '_new'
+    cur.execute(sqlite.timeseries_sql(new, vlbi_type, layout=layout))
+    if layout == 'clustered':
+        cur.execute('INSERT INTO {} (time, station, value, seq) SELECT time, station, value, '
+                    'ROW_NUMBER() OVER (PARTITION BY station, time ORDER BY rowid) - 1 FROM {}'.format(new, table))
+    else:
+        cur.execute('INSERT INTO {} (time, station, value) SELECT time, station, value FROM {} ORDER BY time'.format(new, table))
+    cur.execute('DROP TABLE {}'.format(table))  # also drops its indexes
+    cur.execute('ALTER TABLE {} RENAME TO {}'.format(new, table))
+    if layout == 'rowid':
+        sqlite.create_indexes(cur, table, index='composite')
+
+
+def convert_to_points(cur, table, vlbi_type):
+    cur.execute("SELECT name FROM sqlite_master WHERE name = 'points'")
+    if not cur.fetchone():
+        sqlite.create_points_tables(cur)
+    cur.execute('INSERT OR IGNORE INTO stations (name) SELECT DISTINCT station FROM {}'.format(table))
+    cur.execute('ALTER TABLE {} RENAME TO {}_old'.format(table, table))
+    param_id = sqlite.add_points_view(cur, table.replace('ts_param_', '', 1), vlbi_type)
+    cur.execute('INSERT INTO points (param_id, station_id, time, value, seq) '
+                'SELECT ?, stations.id, time, value, ROW_NUMBER() OVER (PARTITION BY station, time) - 1 '
+                'FROM {}_old JOIN stations ON stations.name = station'.format(table), (param_id,))
+    cur.execute('DROP TABLE {}_old'.format(table))
+
+
+def do_intern_strings(db, max_distinct=0.1, verbose=1):
+    '''Dictionary-encode the TEXT params of a points layout database, one transaction per param.
+
+    Like initdb --intern, the coordinates that get split into floats are left alone.'''
+    transformer.init(verbose=verbose)
+    con = sqlite3.connect(db)
+    con.execute('PRAGMA busy_timeout=10000')
+    cur = con.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)')
+    layouts = sqlite.get_layouts(con)
+    cur.execute("SELECT id, name FROM params WHERE type = 'TEXT'")
+    for param_id, param in cur.fetchall():
+        if layouts.get('ts_param_'+param) != 'points':
+            continue
+        if param in transformer.splitters:
+            if verbose:
+                print(' ', param, 'skipped, coordinate strings are nearly all distinct')
+            continue
+        cur.execute('SELECT COUNT(*), COUNT(DISTINCT value) FROM points WHERE param_id = ?', (param_id,))
+        rows, distinct = cur.fetchone()
+        if rows > 1000 and distinct > rows * max_distinct:
+            if verbose:
+                print(' ', param, 'skipped,', distinct, 'distinct values in', rows, 'rows')
+            continue
+        if verbose:
+            print(' ', param)
+        cur.execute('INSERT OR IGNORE INTO strings (value) SELECT DISTINCT value FROM points WHERE param_id = ? AND value IS NOT NULL', (param_id,))
+        cur.execute('UPDATE points SET value = (SELECT id FROM strings WHERE strings.value = points.value) '
+                    'WHERE param_id = ? AND value IS NOT NULL', (param_id,))
+        cur.execute('DROP VIEW ts_param_{}'.format(param))
+        sqlite.create_points_view(cur, param, param_id, intern=True)
+        con.commit()
+    cur.close()
+    con.close()
+
+
 def do_stuff(db, stuff):
     con = sqlite3.connect(db)
     cur = con.cursor()
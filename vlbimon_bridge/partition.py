@@ -0,0 +1,262 @@
+'''
+Time-partitioned databases.
+
+With bridge --partition, --sqlitedb live.db is a symlink to the partition
+being written, live-2026-10.db for example, and the bridge rolls over to a
+new partition at the start of each month, or of each campaign listed in
+--campaigns. A new partition gets the schema of the previous one, and the
+state the bridge keeps in the database. The previous partition is then
+switched out of WAL mode and made read-only.
+
+connect() ATTACHes the partitions and makes TEMP views over all of them,
+named like the tables, so that queries can span partitions.
+
+Example campaigns.yaml, times are unixtime integers:
+
+2025a:
+  start: 1743552000
+  end: 1744848000
+'''
+
+import glob
+import os
+import os.path
+import re
+import stat
+import sys
+import time
+
+import sqlite3
+import yaml
+
+schemes = ('month', 'campaign')
+
+# copied into a new partition: the state the bridge restores on startup, and the
+# ids that the points layout views use
+carried_tables = ('bridge_stationStatus', 'bridge_eventState', 'params', 'stations')
+
+partition_sql = 'CREATE TABLE bridge_partition (name TEXT NOT NULL, start INTEGER NOT NULL)'
+
+# the names Partitions.name() makes from months
+month_re = re.compile(r'\d{4}-\d{2}(-after-.+)?$')
+
+
+def read_campaigns(fname):
+    with open(os.path.expanduser(fname)) as f:
+        conf = yaml.safe_load(f) or {}
+    campaigns = []
+    for name, window in conf.items():
+        if not isinstance(window, dict) or 'start' not in window or 'end' not in window:
+            raise ValueError('campaign {} needs start and end'.format(name))
+        campaigns.append((str(name), int(window['start']), int(window['end'])))
+    return sorted(campaigns, key=lambda c: c[1])
+
+
+def create_partition(src, dst, name, start, verbose=0):
+    '''Create the partition dst with the schema of the partition src.'''
+    if verbose:
+        print('creating partition', dst, 'from the schema of', src, file=sys.stderr)
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sqlite3.connect(tmp)
+    con.execute('ATTACH DATABASE ? AS src', (src,))
+    auto_vacuum = con.execute('PRAGMA src.auto_vacuum').fetchone()[0]
+    # must come before the first table
+    con.execute('PRAGMA main.auto_vacuum={}'.format(auto_vacuum))
+
+    rows = con.execute("SELECT name, sql FROM src.sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                       "AND name != 'bridge_partition' ORDER BY rowid").fetchall()
+    for name_, sql in rows:
+        con.execute(sql)
+    names = set(r[0] for r in rows)
+    for table in carried_tables:
+        if table in names:
+            con.execute('INSERT INTO main.{0} SELECT * FROM src.{0}'.format(table))
+    con.execute(partition_sql)
+    con.execute('INSERT INTO bridge_partition VALUES (?, ?)', (name, int(start)))
+    con.commit()
+    con.execute('DETACH DATABASE src')
+    con.close()
+    os.replace(tmp, dst)
+
+
+def freeze(path, verbose=0):
+    '''Make a partition that is no longer written read-only. Returns False if it is busy.'''
+    try:
+        # no busy timeout: if a reader has it open, try again later
+        con = sqlite3.connect(path, timeout=0)
+        mode = con.execute('PRAGMA journal_mode=DELETE').fetchone()[0]
+        con.close()
+    except sqlite3.OperationalError as e:
+        if verbose:
+            print('not freezing', path, 'yet:', repr(e), file=sys.stderr)
+        return False
+    if mode != 'delete':
+        return False
+    # readers of a database not in WAL mode do not need to write anything
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    if verbose:
+        print('froze partition', path, file=sys.stderr)
+    return True
+
+
+class Partitions:
+    '''The partition files behind a --sqlitedb symlink, and when to roll over to the next one.'''
+
+    def __init__(self, sqlitedb, scheme, campaigns=None, verbose=0):
+        if scheme not in schemes:
+            raise ValueError('unknown partition scheme '+scheme)
+        self.sqlitedb = sqlitedb
+        self.scheme = scheme
+        self.campaigns = read_campaigns(campaigns) if campaigns else []
+        if scheme == 'campaign' and not self.campaigns:
+            raise ValueError('--partition campaign needs --campaigns')
+        self.verbose = verbose
+        self.current = None
+        self.frozen = []  # retired partitions still waiting to be frozen
+        self.last_freeze = 0
+
+    def name(self, t):
+        '''The partition name for time t: a campaign name, or else the year and month.'''
+        month = time.strftime('%Y-%m', time.gmtime(t))
+        after = None
+        for name, start, end in self.campaigns:
+            if start <= t < end:
+                return name
+            if end <= t and time.strftime('%Y-%m', time.gmtime(end)) == month:
+                after = name
+        if after:
+            # the month's partition from before the campaign is already read-only
+            return month + '-after-' + after
+        return month
+
+    def path(self, name):
+        base, ext = os.path.splitext(self.sqlitedb)
+        return '{}-{}{}'.format(base, name, ext or '.db')
+
+    def link(self, path):
+        '''Atomically point the --sqlitedb symlink at path.'''
+        tmp = self.sqlitedb + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.basename(path), tmp)
+        os.replace(tmp, self.sqlitedb)
+
+    def open(self, now):
+        '''Return the partition to write at startup, rolling over if its time is up.'''
+        if os.path.exists(self.sqlitedb) and not os.path.islink(self.sqlitedb):
+            raise ValueError('--partition needs {0} to be a symlink to a partition. to start partitioning an existing '
+                             'database, stop the bridge and mv {0} {1}'.format(self.sqlitedb, self.path(self.name(now))))
+        previous = os.path.realpath(self.sqlitedb) if os.path.islink(self.sqlitedb) else None
+        if previous and not os.path.isfile(previous):
+            raise ValueError('{} is a symlink to the missing file {}'.format(self.sqlitedb, previous))
+
+        name = self.name(now)
+        path = self.path(name)
+        if not os.path.exists(path):
+            if previous is None:
+                raise ValueError('neither {} nor {} exist, create the partition with initdb'.format(path, self.sqlitedb))
+            create_partition(previous, path, name, now, verbose=self.verbose)
+        elif not os.stat(path).st_mode & stat.S_IWUSR:
+            # the mode, not os.access(), which is always True for root
+            raise ValueError('partition {} has been made read-only, refusing to write it'.format(path))
+        self.link(path)
+        self.current = path
+        if previous and os.path.realpath(previous) != os.path.realpath(path):
+            self.frozen.append(previous)
+        return path
+
+    def due(self, now):
+        return self.path(self.name(now)) != self.current
+
+    def roll(self, now):
+        '''Create the next partition and point the symlink at it. Returns the previous partition,
+        which the caller should close and then retire().'''
+        name = self.name(now)
+        path = self.path(name)
+        previous = self.current
+        if not os.path.exists(path):
+            create_partition(previous, path, name, now, verbose=self.verbose)
+        self.link(path)
+        self.current = path
+        print('rolled over to partition', path, file=sys.stderr)
+        return previous
+
+    def retire(self, path):
+        self.frozen.append(path)
+        self.freeze_pending(force=True)
+
+    def freeze_pending(self, force=False, interval=60):
+        if not self.frozen or (not force and time.time() < self.last_freeze + interval):
+            return
+        self.last_freeze = time.time()
+        self.frozen = [p for p in self.frozen if not freeze(p, verbose=self.verbose)]
+
+
+def get_partitions(sqlitedb):
+    '''Return (start, path) of the partitions of sqlitedb, oldest first.
+
+    A partition made by initdb, or renamed from an unpartitioned database,
+    has no bridge_partition table, and is taken to cover everything before
+    the next one. Such a file is only a partition if it is named for a month,
+    so that other databases that happen to match base-*.db are left alone.'''
+    base, ext = os.path.splitext(sqlitedb)
+    ext = ext or '.db'
+    ret = []
+    for path in glob.glob(glob.escape(base) + '-*' + ext):
+        name = path[len(base)+1:-len(ext)]
+        con = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        try:
+            start = con.execute('SELECT start FROM bridge_partition').fetchone()[0]
+        except sqlite3.OperationalError:
+            # no such table
+            start = 0 if month_re.match(name) else None
+        except sqlite3.DatabaseError:
+            # not a database
+            start = None
+        finally:
+            con.close()
+        if start is None:
+            print('warning: skipping', path, 'which is not a partition of', sqlitedb, file=sys.stderr)
+            continue
+        ret.append((start, path))
+    return sorted(ret)
+
+
+def connect(sqlitedb, start=None, end=None, verbose=0):
+    '''Return a connection with the partitions of sqlitedb that overlap [start, end) attached read-only,
+    and TEMP views over all of them of the ts_param_ and ts_rollup_ tables.'''
+    partitions = get_partitions(sqlitedb)
+    chosen = []
+    for i, (p_start, path) in enumerate(partitions):
+        p_end = partitions[i+1][0] if i+1 < len(partitions) else None
+        if end is not None and p_start >= end:
+            continue
+        if start is not None and p_end is not None and p_end <= start:
+            continue
+        chosen.append(path)
+    if not chosen:
+        raise ValueError('no partitions of {} found'.format(sqlitedb))
+
+    con = sqlite3.connect(':memory:', uri=True)
+    limit = con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(con, 'getlimit') else 10
+    if len(chosen) > limit:
+        raise ValueError('{} partitions is more than sqlite can attach ({}), narrow the time range'.format(len(chosen), limit))
+
+    tables = {}
+    for i, path in enumerate(chosen):
+        schema = 'p{}'.format(i)
+        if verbose:
+            print('attaching', path, 'as', schema, file=sys.stderr)
+        con.execute('ATTACH DATABASE ? AS {}'.format(schema), ('file:{}?mode=ro'.format(path),))
+        for name, in con.execute("SELECT name FROM {}.sqlite_master WHERE type IN ('table', 'view') "
+                                 "AND (name LIKE 'ts_param_%' OR name LIKE 'ts_rollup_%')".format(schema)):
+            tables.setdefault(name, []).append(schema)
+
+    for name, schemas in tables.items():
+        # a clustered table has an extra seq column
+        cols = 'time, station, value' if name.startswith('ts_param_') and name != 'ts_param_schedule' else '*'
+        selects = ['SELECT {} FROM {}.{}'.format(cols, schema, name) for schema in schemas]
+        con.execute('CREATE TEMP VIEW {} AS {}'.format(name, ' UNION ALL '.join(selects)))
+    return con
@@ -0,0 +1,255 @@
+'''
+Aging out old points: after some days, delete them, or thin them to one point
+per station per interval. The rollup tables are not touched.
+
+The deletes are done in many small transactions, with a pause in between,
+so that a running bridge, whose busy timeout is short, is never held up.
+
+Example retention.yaml, keys are params or param prefixes ending in *,
+and the longest match wins:
+
+telescope_azimuthElevation*:
+  days: 30       # keep 30 days of raw points
+  thin: 60       # then keep one point per station per 60 seconds
+  thin_days: 365 # and delete those after a year
+if_*:
+  days: 365      # then delete, the rollups remain
+'''
+
+import os.path
+import sys
+import time
+
+import sqlite3
+import yaml
+
+from . import sqlite
+from . import utils
+
+policy_keys = {'days', 'thin', 'thin_days'}
+
+# the time before which each param's points have been deleted or thinned. rollup uses it too
+retention_sql = 'CREATE TABLE IF NOT EXISTS bridge_retention (param TEXT NOT NULL PRIMARY KEY, aged INTEGER NOT NULL)'
+
+
+def read_config(fname):
+    with open(os.path.expanduser(fname)) as f:
+        conf = yaml.safe_load(f) or {}
+    for pattern, policy in conf.items():
+        if not isinstance(policy, dict) or 'days' not in policy:
+            raise ValueError('retention policy for {} needs days'.format(pattern))
+        extra = set(policy) - policy_keys
+        if extra:
+            raise ValueError('unknown retention settings for {}: {}'.format(pattern, ', '.join(sorted(extra))))
+        if 'thin_days' in policy and 'thin' not in policy:
+            raise ValueError('retention policy for {} has thin_days but not thin'.format(pattern))
+        if policy.get('thin_days', policy['days']) < policy['days']:
+            raise ValueError('retention policy for {} has thin_days < days'.format(pattern))
+    return conf
+
+
+def get_policy(conf, param):
+    '''Return the policy of param, an exact match or else the longest matching prefix*.'''
+    if param in conf:
+        return conf[param]
+    best = None
+    for pattern in conf:
+        if pattern.endswith('*') and param.startswith(pattern[:-1]):
+            if best is None or len(pattern) > len(best):
+                best = pattern
+    return conf[best] if best else None
+
+
+class Table:
+    '''The sql to age out the points of one param, in any layout.'''
+
+    def __init__(self, con, param):
+        self.param = param
+        table = 'ts_param_' + param
+        layout = sqlite.get_layouts(con)[table]
+        if layout in ('points', 'points_strings'):
+            # delete from the points table behind the view, stations are ids
+            param_id = sqlite.get_param_ids(con)[param]
+            table = 'points'
+            where = 'param_id = {} AND station_id = ?1'.format(param_id)
+            key = 'seq'
+            self.stations = [r[0] for r in con.execute('SELECT id FROM stations')]
+        else:
+            where = 'station = ?1'
+            if layout == 'rowid' and sqlite.get_index_mode(con.cursor(), table) == 'separate':
+                # left alone, sqlite picks the station index and reads all of the station's points
+                where = '+station = ?1'
+            key = 'rowid' if layout == 'rowid' else 'seq'
+            self.stations = [r[0] for r in con.execute('SELECT DISTINCT station FROM ' + table)]
+
+        self.next_sql = 'SELECT min(time) FROM {} WHERE {} AND time >= ?2'.format(table, where)
+        self.delete_sql = 'DELETE FROM {} WHERE {} AND time < ?2'.format(table, where)
+        self.count_sql = 'SELECT COUNT(*) FROM {} WHERE {} AND time < ?2'.format(table, where)
+        # keep the earliest point of each station in each thin interval. with exactly
+        # one min(), sqlite takes the bare column from the same row
+        self.thin_sql = ('DELETE FROM {0} WHERE {1} AND time >= ?2 AND time < ?3 AND (time, {2}) NOT IN '
+                         '(SELECT min(time), {2} FROM {0} WHERE {1} AND time >= ?2 AND time < ?3 GROUP BY time / ?4)').format(table, where, key)
+        self.thin_count_sql = ('SELECT COUNT(*) - COUNT(DISTINCT time / ?4) FROM {} WHERE {} AND time >= ?2 AND time < ?3').format(table, where)
+
+    def next_time(self, cur, station, start):
+        cur.execute(self.next_sql, (station, start))
+        return cur.fetchone()[0]
+
+
+class Pacer:
+    '''Sizes each transaction's time window to delete about target rows.'''
+
+    def __init__(self, target, window=3600, min_window=60, max_window=30*86400):
+        self.target = target
+        self.min_window = min_window
+        self.max_window = max_window
+        self.window = window
+
+    def observe(self, window, rows):
+        new_window = window * self.target / max(rows, 1)
+        self.window = int(min(self.max_window, max(self.min_window, min(new_window, window * 4))))
+
+
+def commit(con, pause):
+    con.commit()
+    if pause:
+        time.sleep(pause)
+
+
+def delete_before(cmd, con, table, cutoff, pacer):
+    '''Delete the points of table before cutoff.'''
+    cur = con.cursor()
+    total = 0
+    for station in table.stations:
+        if cmd.dry_run:
+            cur.execute(table.count_sql, (station, cutoff))
+            total += cur.fetchone()[0]
+            continue
+        start = table.next_time(cur, station, 0)
+        while start is not None and start < cutoff:
+            end = min(start + pacer.window, cutoff)
+            cur.execute(table.delete_sql, (station, end))
+            pacer.observe(end - start, cur.rowcount)
+            total += cur.rowcount
+            commit(con, cmd.pause)
+            start = table.next_time(cur, station, end)
+    cur.close()
+    return total
+
+
+def thin_between(cmd, con, table, start, cutoff, thin, pacer):
+    '''Thin the points of table from start to cutoff to one per station per thin seconds.'''
+    cur = con.cursor()
+    total = 0
+    for station in table.stations:
+        if cmd.dry_run:
+            cur.execute(table.thin_count_sql, (station, start, cutoff, thin))
+            total += cur.fetchone()[0]
+            continue
+        t = table.next_time(cur, station, start)
+        while t is not None and t < cutoff:
+            # windows are whole thin intervals, so no interval is split between transactions
+            t -= t % thin
+            end = min(t + max(pacer.window - pacer.window % thin, thin), cutoff)
+            cur.execute(table.thin_sql, (station, t, end, thin))
+            pacer.observe(end - t, cur.rowcount)
+            total += cur.rowcount
+            commit(con, cmd.pause)
+            t = table.next_time(cur, station, end)
+    cur.close()
+    return total
+
+
+def get_aged(con):
+    '''Return a dict of param: time before which its points have been deleted or thinned.'''
+    try:
+        return dict(con.execute('SELECT param, aged FROM bridge_retention'))
+    except sqlite3.OperationalError:
+        # retention has never run
+        return {}
+
+
+def set_aged(con, param, aged):
+    con.execute('INSERT OR REPLACE INTO bridge_retention VALUES (?, ?)', (param, aged))
+    con.commit()
+
+
+def incremental_vacuum(cmd, con):
+    '''Give the free pages back to the filesystem, a few at a time.'''
+    cur = con.cursor()
+    auto_vacuum = cur.execute('PRAGMA auto_vacuum').fetchone()[0]
+    if auto_vacuum != 2:
+        # 0 = NONE, 1 = FULL, 2 = INCREMENTAL
+        print('not vacuuming, auto_vacuum is not INCREMENTAL, see the README', file=sys.stderr)
+        cur.close()
+        return 0
+    freed = 0
+    while True:
+        free = cur.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            break
+        # execute() would only step this pragma once, freeing one page
+        con.executescript('PRAGMA incremental_vacuum({})'.format(min(free, cmd.vacuum_pages)))
+        freed += min(free, cmd.vacuum_pages)
+        if cmd.pause:
+            time.sleep(cmd.pause)
+    cur.close()
+    return freed
+
+
+def retention(cmd):
+    verbose = cmd.verbose
+    sqlitedb = cmd.sqlitedb
+
+    if not os.path.isfile(sqlitedb):
+        raise ValueError('database file {} does not exist'.format(sqlitedb))
+    utils.checkout_db(sqlitedb, mode='w')
+    conf = read_config(cmd.config)
+
+    con = sqlite3.connect(sqlitedb, factory=sqlite.Connection)
+    # we wait for the bridge, never the other way around
+    con.execute('PRAGMA busy_timeout=10000')
+    con.execute(retention_sql)
+    con.commit()
+    aged = get_aged(con)
+
+    now = int(time.time())
+    t0 = time.time()
+    total = 0
+    try:
+        for table_name in sorted(sqlite.get_layouts(con)):
+            param = table_name.replace('ts_param_', '', 1)
+            policy = get_policy(conf, param)
+            if policy is None or param == 'schedule':
+                continue
+            if cmd.param and param not in cmd.param:
+                continue
+            table = Table(con, param)
+            pacer = Pacer(cmd.batch)
+            cutoff = now - int(policy['days'] * 86400)
+            verb = 'would delete' if cmd.dry_run else 'deleted'
+
+            if 'thin' not in policy:
+                count = delete_before(cmd, con, table, cutoff, pacer)
+            else:
+                thin = int(policy['thin'])
+                cutoff -= cutoff % thin
+                count = 0
+                if 'thin_days' in policy:
+                    count += delete_before(cmd, con, table, now - int(policy['thin_days'] * 86400), pacer)
+                count += thin_between(cmd, con, table, aged.get(param, 0), cutoff, thin, pacer)
+            if not cmd.dry_run:
+                set_aged(con, param, max(cutoff, aged.get(param, 0)))
+            if verbose or cmd.dry_run:
+                print(verb, count, 'points of', param, file=sys.stderr)
+            total += count
+
+        if not cmd.dry_run and not cmd.no_vacuum:
+            freed = incremental_vacuum(cmd, con)
+            if verbose:
+                print('vacuumed', freed, 'pages', file=sys.stderr)
+    finally:
+        con.close()
+
+    elapsed = time.time() - t0
+    print('{} {} points in {} seconds'.format('would delete' if cmd.dry_run else 'deleted', total, round(elapsed, 1)), file=sys.stderr)
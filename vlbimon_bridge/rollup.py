@@ -0,0 +1,144 @@
+import os.path
+import sys
+import time
+
+import sqlite3
+
+from . import retention
+from . import sqlite
+from . import utils
+
+
+def align(start, end):
+    '''Widen [start, end) to whole buckets of the longest rollup interval.'''
+    longest = sqlite.rollup_intervals[-1][1]
+    if start is not None:
+        start -= start % longest
+    if end is not None and end % longest:
+        end += longest - end % longest
+    return start, end
+
+
+def delete_rollups(cur, table, stations=None, start=None, end=None):
+    where = []
+    args = []
+    if stations:
+        where.append('station IN ({})'.format(', '.join(['?'] * len(stations))))
+        args.extend(stations)
+    if start is not None:
+        where.append('time >= ?')
+        args.append(start)
+    if end is not None:
+        where.append('time < ?')
+        args.append(end)
+    sql = 'DELETE FROM ' + table
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    cur.execute(sql, args)
+    return cur.rowcount
+
+
+def time_bounds(con, param, stations, by_time=False):
+    '''Return the time of the first point of param at stations, and one past the last, or None, None.'''
+    table = 'ts_param_' + param
+    where = '+station = ?' if by_time else 'station = ?'
+    first = last = None
+    for station in stations:
+        # one aggregate per query, so that sqlite can answer it from an index
+        lo = con.execute('SELECT min(time) FROM {} WHERE {}'.format(table, where), (station,)).fetchone()[0]
+        hi = con.execute('SELECT max(time) FROM {} WHERE {}'.format(table, where), (station,)).fetchone()[0]
+        if lo is not None:
+            first = lo if first is None else min(first, lo)
+            last = hi if last is None else max(last, hi)
+    if first is None:
+        return None, None
+    return int(first), int(last) + 1
+
+
+def backfill_one(con, param, stations=None, start=None, end=None, batch=20000, pause=0.05, verbose=0):
+    '''Recompute the rollups of param between start and end from its points.
+
+    Each transaction covers a window of whole buckets of the longest interval,
+    sized to hold about batch points, so the bridge is never locked out for long.'''
+    longest = sqlite.rollup_intervals[-1][1]
+    table = 'ts_param_' + param
+    cur = con.cursor()
+    # left alone, sqlite picks the station index and reads all of the station's points for every window
+    by_time = sqlite.get_layouts(con).get(table) == 'rowid' and sqlite.get_index_mode(cur, table) in ('separate', None)
+    query_stations = stations or [r[0] for r in cur.execute('SELECT DISTINCT station FROM ' + table)]
+    first, last = time_bounds(con, param, query_stations, by_time=by_time)
+    if first is None:
+        cur.close()
+        return 0
+    start, end = align(first if start is None else start, last if end is None else end)
+
+    pacer = retention.Pacer(batch, window=longest, min_window=longest)
+    count = 0
+    t = start
+    while t < end:
+        t_end = min(t + pacer.window - pacer.window % longest, end)
+        for name, interval in sqlite.rollup_intervals:
+            deleted = delete_rollups(cur, sqlite.rollup_table(param, name), stations=stations, start=t, end=t_end)
+            if verbose > 1:
+                print('deleted', deleted, name, 'rollups of', param, 'from', t, 'to', t_end, file=sys.stderr)
+        # the merge does not care about order, so skip the sort
+        rows = sqlite.query_timeseries(con, param, stations=query_stations, start=t, end=t_end, order=False, by_time=by_time).fetchall()
+        sqlite.insert_rollups(con, cur, param, rows, verbose=verbose)
+        retention.commit(con, pause)
+        pacer.observe(t_end - t, len(rows))
+        count += len(rows)
+        t = t_end
+    cur.close()
+    return count
+
+
+def rollup(cmd):
+    verbose = cmd.verbose
+    sqlitedb = cmd.sqlitedb
+
+    if not os.path.isfile(sqlitedb):
+        raise ValueError('database file {} does not exist'.format(sqlitedb))
+    utils.checkout_db(sqlitedb, mode='w')
+
+    con = sqlite3.connect(sqlitedb, factory=sqlite.Connection)
+    cur = con.cursor()
+    cur.execute('PRAGMA busy_timeout=10000')
+
+    # older databases do not have the rollup tables yet
+    types = sqlite.timeseries_types(verbose=verbose)
+    tables = set(r[0] for r in cur.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name LIKE 'ts_param_%'"))
+    params = []
+    for param, vlbi_type in sorted(types.items()):
+        if vlbi_type not in sqlite.rollup_types or 'ts_param_' + param not in tables:
+            continue
+        if cmd.param and param not in cmd.param:
+            continue
+        sqlite.add_rollups(cur, param, vlbi_type, verbose=verbose)
+        params.append(param)
+    con.commit()
+    cur.close()
+    sqlite.forget_schema(con)
+
+    start, end = align(cmd.start, cmd.end)
+    if verbose:
+        print('backfilling rollups of', len(params), 'params from', start, 'to', end, file=sys.stderr)
+    aged = retention.get_aged(con)
+
+    t0 = time.time()
+    total = 0
+    try:
+        for param in params:
+            param_start = start
+            if param in aged:
+                # the points before this were deleted or thinned, but their rollups are still good
+                param_start = align(max(start or 0, aged[param]) + sqlite.rollup_intervals[-1][1] - 1, None)[0]
+            count = backfill_one(con, param, stations=cmd.stations, start=param_start, end=end,
+                                 batch=cmd.batch, pause=cmd.pause, verbose=verbose)
+            if verbose:
+                print('rolled up', count, 'points of', param, file=sys.stderr)
+            total += count
+    finally:
+        con.close()
+
+    elapsed = time.time() - t0
+    print('rolled up {} points in {} seconds'.format(total, round(elapsed, 1)), file=sys.stderr)
@@ -9,14 +9,23 @@ from . import transformer
 from . import utils
 
 
-vlbi_types = types.get_types()
 to_sql_types = {
     int: 'INTEGER',
     float: 'REAL',
     str: 'TEXT',
     bool: 'BOOLEAN',
 }
-vlbi_types = dict([(name, to_sql_types[ty]) for name, ty in vlbi_types.items()])
+vlbi_types = None
+
+
+def get_vlbi_types():
+    '''Return a dict of vlbimon param: sql type, read from ./vlbimon_types.csv the first time,
+    so that commands that only read a database do not need that file.'''
+    global vlbi_types
+    if vlbi_types is None:
+        vlbi_types = dict([(name, to_sql_types[ty]) for name, ty in types.get_types().items()])
+    return vlbi_types
+
 
 stations = ['ALMA', 'APEX', 'GLT', 'JCMT', 'KP', 'LMT', 'NOEMA', 'PICO', 'SMA', 'SMTO', 'SPT']
 
@@ -40,6 +49,39 @@ stationStatus_cols = [
 ]
 
 
+# the last value of each (station, param) event, see transformer.value_hash
+eventState_sql = ('CREATE TABLE bridge_eventState (station TEXT NOT NULL, param TEXT NOT NULL, '
+                  'hash INTEGER NOT NULL, time INTEGER NOT NULL, PRIMARY KEY (station, param)) WITHOUT ROWID')
+
+bridge_tables = (
+    ('events', 'TEXT'),
+    ('points', 'INTEGER'),
+    ('totalLag', 'REAL'),
+    ('bridgeLag', 'REAL'),
+    ('forecastTau225', 'REAL'),
+    ('avgWindSpeed', 'REAL'),
+    ('windGust', 'REAL'),
+    ('circuitState', 'TEXT'),
+    ('failures', 'INTEGER'),
+    ('checkpointTime', 'REAL'),
+    ('walSize', 'INTEGER'),
+)
+
+
+def timeseries_types(verbose=0):
+    '''Return a dict of param: sql type for all of the ts_param_ tables.'''
+    transformer.init(verbose=verbose)
+    ret = {}
+    for param, vlbi_type in get_vlbi_types().items():
+        ret[param.split('.')[0]] = vlbi_type
+    for param in transformer.splitters_expanded:
+        if param not in ret:
+            ret[param] = 'REAL'
+    for param, vlbi_type in bridge_tables:
+        ret['bridge_'+param] = vlbi_type
+    return ret
+
+
 def initdb(cmd):
     verbose = cmd.verbose
     sqlitedb = cmd.sqlitedb
@@ -52,29 +94,21 @@ def initdb(cmd):
     utils.checkout_db(sqlitedb, mode='w')
     con = sqlite3.connect(sqlitedb)
     cur = con.cursor()
-
-    transformer.init(verbose=verbose)
-    for param in transformer.splitters_expanded:
-        if param not in vlbi_types:
-            vlbi_types[param] = 'REAL'
-
-    for param, vlbi_type in vlbi_types.items():
-        param = param.split('.')[0]
+    # must come before the first table. lets retention give deleted space back a bit at a time
+    cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+
+    layout = cmd.layout
+    if cmd.intern:
+        if layout != 'points':
+            raise ValueError('--intern requires --layout points')
+        layout = 'points_strings'
+    if layout.startswith('points'):
+        create_points_tables(cur)
+    for param, vlbi_type in timeseries_types(verbose=verbose).items():
         if verbose:
             print(param, vlbi_type)
-        add_timeseries(cur, param, vlbi_type, verbose=verbose)
-
-    bridge_tables = (
-        ('events', 'TEXT'),
-        ('points', 'INTEGER'),
-        ('totalLag', 'REAL'),
-        ('bridgeLag', 'REAL'),
-        ('forecastTau225', 'REAL'),
-        ('avgWindSpeed', 'REAL'),
-        ('windGust', 'REAL'),
-    )
-    for param, vlbi_type in bridge_tables:
-        add_timeseries(cur, 'bridge_'+param, vlbi_type, verbose=verbose)
+        add_timeseries(cur, param, vlbi_type, index=cmd.index, layout=layout, verbose=verbose)
+        add_rollups(cur, param, vlbi_type, verbose=verbose)
 
     cur.execute('CREATE TABLE ts_param_schedule (time INTEGER NOT NULL, stations TEXT NOT NULL, scan TEXT NOT NULL)')
 
@@ -83,6 +117,8 @@ def initdb(cmd):
     cur.execute('CREATE TABLE bridge_stationStatus ('+station_collist+')')
     # sqlite will create sqlite_autoindex_bridge_stationStatus_1 because of the primary key
 
+    cur.execute(eventState_sql)
+
     cur.close()
     con.commit()
     con.close()
@@ -90,6 +126,7 @@ def initdb(cmd):
 
 def connect(database, *args, wal_size=None, verbose=0, **kwargs):
     utils.checkout_db(database, mode='w')
+    kwargs.setdefault('factory', Connection)
     con = sqlite3.connect(database, *args, **kwargs)
 
     cur = con.cursor()
@@ -104,17 +141,361 @@ def connect(database, *args, wal_size=None, verbose=0, **kwargs):
         for row in cur.execute('PRAGMA synchronous'):
             assert row[0] == 1  # 1=NORMAL, does not persist
         for row in cur.execute('PRAGMA wal_autocheckpoint'):
-            assert row[0] == 1000  # the default
+            assert row[0] == (1000 if wal_size is None else wal_size)
         for row in cur.execute('PRAGMA busy_timeout'):
             assert row[0] == 100
         cur.close()
     return con
 
 
-def add_timeseries(cur, param, vlbi_type, verbose=0):
-    cur.execute('CREATE TABLE ts_param_{} (time INTEGER NOT NULL, station TEXT NOT NULL, value {})'.format(param, vlbi_type))
-    cur.execute('CREATE INDEX idx_ts_param_{}_time ON ts_param_{}(time)'.format(param, param))
-    cur.execute('CREATE INDEX idx_ts_param_{}_station ON ts_param_{}(station)'.format(param, param))
+def add_timeseries(cur, param, vlbi_type, index='separate', layout='rowid', verbose=0):
+    table = 'ts_param_' + param
+    if layout in ('points', 'points_strings'):
+        # coordinate strings are nearly all distinct, interning them would not save anything
+        intern = layout == 'points_strings' and param not in transformer.splitters
+        add_points_view(cur, param, vlbi_type, intern=intern)
+        return
+    cur.execute(timeseries_sql(table, vlbi_type, layout=layout))
+    if layout == 'rowid':
+        create_indexes(cur, table, index=index, verbose=verbose)
+
+
+# rowid: the original layout, a heap table plus secondary indexes
+# clustered: a WITHOUT ROWID table stored in (station, time, seq) order, no secondary indexes.
+#   seq numbers points that share a station and time
+# points: one narrow WITHOUT ROWID points table for all params, with params and stations
+#   dictionary-encoded as integers, and a ts_param_ view per param for Grafana
+# points_strings: a TEXT param in the points layout whose values are also dictionary-encoded,
+#   in the strings table. not a choice for initdb --layout, see initdb --intern
+layouts = ('rowid', 'clustered', 'points')
+
+
+def timeseries_sql(table, vlbi_type, layout='rowid'):
+    if layout == 'rowid':
+        return 'CREATE TABLE {} (time INTEGER NOT NULL, station TEXT NOT NULL, value {})'.format(table, vlbi_type)
+    if layout == 'clustered':
+        return ('CREATE TABLE {} (time INTEGER NOT NULL, station TEXT NOT NULL, value {}, seq INTEGER NOT NULL DEFAULT 0, '
+                'PRIMARY KEY (station, time, seq)) WITHOUT ROWID').format(table, vlbi_type)
+    raise ValueError('unknown layout '+layout)
+
+
+def insert_sql(table, layout='rowid'):
+    if layout == 'clustered':
+        return ('INSERT INTO {0} (time, station, value, seq) VALUES (?1, ?2, ?3, '
+                '(SELECT COUNT(*) FROM {0} WHERE station = ?2 AND time = ?1))').format(table)
+    if layout in ('points', 'points_strings'):
+        return ('INSERT INTO points (param_id, station_id, time, value, seq) VALUES (?1, ?2, ?3, ?4, '
+                '(SELECT COUNT(*) FROM points WHERE param_id = ?1 AND station_id = ?2 AND time = ?3))')
+    return 'INSERT INTO {} VALUES(?, ?, ?)'.format(table)
+
+
+def create_points_tables(cur):
+    cur.execute('CREATE TABLE params (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, type TEXT NOT NULL)')
+    cur.execute('CREATE TABLE stations (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+    cur.execute('CREATE TABLE points (param_id INTEGER NOT NULL, station_id INTEGER NOT NULL, time INTEGER NOT NULL, '
+                'value, seq INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (param_id, station_id, time, seq)) WITHOUT ROWID')
+    cur.execute('CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)')
+
+
+def add_points_view(cur, param, vlbi_type, intern=False):
+    cur.execute('INSERT INTO params (name, type) VALUES (?, ?)', (param, vlbi_type))
+    param_id = cur.lastrowid
+    create_points_view(cur, param, param_id, intern=intern and vlbi_type == 'TEXT')
+    return param_id
+
+
+def create_points_view(cur, param, param_id, intern=False):
+    if intern:
+        # LEFT JOIN keeps NULL values
+        cur.execute('CREATE VIEW ts_param_{} AS SELECT points.time AS time, stations.name AS station, strings.value AS value '
+                    'FROM points JOIN stations ON stations.id = points.station_id LEFT JOIN strings ON strings.id = points.value '
+                    'WHERE points.param_id = {}'.format(param, param_id))
+    else:
+        cur.execute('CREATE VIEW ts_param_{} AS SELECT points.time AS time, stations.name AS station, points.value AS value '
+                    'FROM points JOIN stations ON stations.id = points.station_id WHERE points.param_id = {}'.format(param, param_id))
+
+
+# rollups: per-station aggregates of the numeric params over fixed intervals, so that
+# graphs of weeks or months do not have to read every point. insert_many_ts keeps them
+# up to date, and the rollup command backfills them. each interval divides the next
+rollup_intervals = (('1m', 60), ('1h', 3600))
+rollup_types = ('REAL', 'INTEGER')
+
+
+def rollup_table(param, name):
+    return 'ts_rollup_{}_{}'.format(name, param)
+
+
+def rollup_sql(table):
+    # the mean is sum / count
+    return ('CREATE TABLE IF NOT EXISTS {} (time INTEGER NOT NULL, station TEXT NOT NULL, min REAL, max REAL, sum REAL, '
+            'count INTEGER NOT NULL, last REAL, last_time INTEGER NOT NULL, PRIMARY KEY (station, time)) WITHOUT ROWID').format(table)
+
+
+def rollup_upsert_sql(table):
+    # sqlite >= 3.24. the SET expressions all see the old row
+    return ('INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (station, time) DO UPDATE SET '
+            'min = min(min, excluded.min), max = max(max, excluded.max), '
+            'sum = sum + excluded.sum, count = count + excluded.count, '
+            'last = CASE WHEN excluded.last_time >= last_time THEN excluded.last ELSE last END, '
+            'last_time = max(last_time, excluded.last_time)').format(table)
+
+
+def add_rollups(cur, param, vlbi_type, verbose=0):
+    '''Create the missing rollup tables of a numeric param.'''
+    if vlbi_type not in rollup_types:
+        return
+    for name, interval in rollup_intervals:
+        table = rollup_table(param, name)
+        if verbose > 1:
+            print('creating', table, file=sys.stderr)
+        cur.execute(rollup_sql(table))
+
+
+def point_rollups(data):
+    '''Turn (time, station, value) points into single-point rollup rows, skipping non-numeric values.'''
+    for recv_time, station, value in data:
+        if isinstance(value, (int, float)):
+            recv_time = int(recv_time)
+            yield recv_time, station, value, value, value, 1, value, recv_time
+
+
+def merge_rollups(rows, interval):
+    '''Combine (time, station, min, max, sum, count, last, last_time) rows into interval buckets.'''
+    buckets = {}
+    for t, station, min_, max_, sum_, count, last, last_time in rows:
+        key = (t - t % interval, station)
+        b = buckets.get(key)
+        if b is None:
+            buckets[key] = [min_, max_, sum_, count, last, last_time]
+            continue
+        if min_ < b[0]:
+            b[0] = min_
+        if max_ > b[1]:
+            b[1] = max_
+        b[2] += sum_
+        b[3] += count
+        if last_time >= b[5]:
+            b[4] = last
+            b[5] = last_time
+    return [(t, station, *b) for (t, station), b in buckets.items()]
+
+
+def get_rollups(con):
+    '''Return the set of rollup tables.'''
+    rollups = getattr(con, 'rollups', None)
+    if rollups is None:
+        rollups = set(r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'ts_rollup_%'"))
+        if isinstance(con, Connection):
+            con.rollups = rollups
+    return rollups
+
+
+def insert_rollups(con, cur, param, data, verbose=0):
+    '''Add (time, station, value) points of param to its rollup tables, if it has any.
+
+    Errors are raised, so that the caller can roll back the points too.'''
+    rollups = get_rollups(con)
+    if rollup_table(param, rollup_intervals[0][0]) not in rollups:
+        return
+    rows = point_rollups(data)
+    for name, interval in rollup_intervals:
+        table = rollup_table(param, name)
+        if table not in rollups:
+            break
+        rows = merge_rollups(rows, interval)
+        cur.executemany(rollup_upsert_sql(table), rows)
+
+
+class Connection(sqlite3.Connection):
+    '''A sqlite3 connection that remembers the layout of its timeseries tables.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.layouts = None
+        self.rollups = None
+        self.param_ids = None
+        self.station_ids = None
+        self.string_ids = None
+
+
+def forget_schema(con):
+    '''Call after changing the schema, or after a rollback.'''
+    if isinstance(con, Connection):
+        con.layouts = None
+        con.rollups = None
+        con.param_ids = None
+        con.station_ids = None
+        con.string_ids = None
+
+
+def get_layouts(con):
+    '''Return a dict of table: layout for the ts_param_ tables.'''
+    layouts = getattr(con, 'layouts', None)
+    if layouts is not None:
+        return layouts
+
+    layouts = {}
+    cur = con.cursor()
+    cur.execute("SELECT name, type, sql FROM sqlite_master WHERE type IN ('table', 'view') AND name LIKE 'ts_param_%'")
+    for name, type_, sql in cur.fetchall():
+        if type_ == 'view':
+            layouts[name] = 'points_strings' if 'JOIN strings' in sql else 'points'
+        elif 'WITHOUT ROWID' in sql.upper():
+            layouts[name] = 'clustered'
+        else:
+            layouts[name] = 'rowid'
+    cur.close()
+
+    if isinstance(con, Connection):
+        con.layouts = layouts
+    return layouts
+
+
+def get_db_layout(cur):
+    '''Guess the layout of a database from one of its timeseries tables.'''
+    cur.execute("SELECT type, sql FROM sqlite_master WHERE name = 'ts_param_bridge_events'")
+    row = cur.fetchone()
+    if row and row[0] == 'view':
+        return 'points_strings' if 'JOIN strings' in row[1] else 'points'
+    if row and 'WITHOUT ROWID' in row[1].upper():
+        return 'clustered'
+    return 'rowid'
+
+
+def get_param_ids(con):
+    param_ids = getattr(con, 'param_ids', None)
+    if param_ids is None:
+        param_ids = dict((name, id_) for id_, name in con.execute('SELECT id, name FROM params'))
+        if isinstance(con, Connection):
+            con.param_ids = param_ids
+    return param_ids
+
+
+def get_station_ids(con, cur, stations):
+    '''Return a dict of station name: id, adding any new stations.'''
+    station_ids = getattr(con, 'station_ids', None)
+    if station_ids is None:
+        station_ids = dict((name, id_) for id_, name in con.execute('SELECT id, name FROM stations'))
+        if isinstance(con, Connection):
+            con.station_ids = station_ids
+    for station in stations:
+        if station not in station_ids:
+            cur.execute('INSERT INTO stations (name) VALUES (?)', (station,))
+            station_ids[station] = cur.lastrowid
+    return station_ids
+
+
+def get_string_ids(con, cur, values):
+    '''Return a dict of string: id, adding any new strings.'''
+    string_ids = getattr(con, 'string_ids', None)
+    if string_ids is None:
+        string_ids = {}
+        if isinstance(con, Connection):
+            con.string_ids = string_ids
+    for value in values:
+        if value is None or value in string_ids:
+            continue
+        cur.execute('INSERT OR IGNORE INTO strings (value) VALUES (?)', (value,))
+        cur.execute('SELECT id FROM strings WHERE value = ?', (value,))
+        string_ids[value] = cur.fetchone()[0]
+    return string_ids
+
+
+def points_rows(con, cur, param, data, intern=False):
+    '''Turn (time, station, value) rows into points table rows.'''
+    param_id = get_param_ids(con)[param]
+    station_ids = get_station_ids(con, cur, set(d[1] for d in data))
+    if intern:
+        string_ids = get_string_ids(con, cur, set(d[2] for d in data))
+        return [(param_id, station_ids[station], recv_time, string_ids.get(value)) for recv_time, station, value in data]
+    return [(param_id, station_ids[station], recv_time, value) for recv_time, station, value in data]
+
+
+def query_timeseries(con, param, stations=None, start=None, end=None, order=True, by_time=False):
+    '''Return a cursor over the (time, station, value) rows of one param, in any layout.
+
+    The ts_param_ name is a table or a view, and the views turn dictionary ids back into text.
+    by_time keeps sqlite from using a station index, for a short time range in a table with
+    separate indexes.'''
+    where = []
+    args = []
+    if stations:
+        where.append('{}station IN ({})'.format('+' if by_time else '', ', '.join(['?'] * len(stations))))
+        args.extend(stations)
+    if start is not None:
+        where.append('time >= ?')
+        args.append(start)
+    if end is not None:
+        where.append('time < ?')
+        args.append(end)
+    sql = 'SELECT time, station, value FROM ts_param_{}'.format(param)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    if order:
+        sql += ' ORDER BY time'
+    return con.execute(sql, args)
+
+
+# separate: the original layout, one index on time and one on station
+# composite: one index on (station, time), which serves "station X from t1 to t2"
+# covering: (station, time, value), which answers those queries without reading the table
+index_modes = {
+    'separate': (('time', ('time',)), ('station', ('station',))),
+    'composite': (('station_time', ('station', 'time')),),
+    'covering': (('station_time_value', ('station', 'time', 'value')),),
+}
+
+
+def index_sqls(table, index='separate'):
+    if index not in index_modes:
+        raise ValueError('unknown index mode '+index)
+    return ['CREATE INDEX idx_{}_{} ON {}({})'.format(table, suffix, table, ', '.join(cols))
+            for suffix, cols in index_modes[index]]
+
+
+def create_indexes(cur, table, index='separate', verbose=0):
+    restore_indexes(cur, index_sqls(table, index=index), verbose=verbose)
+
+
+def get_index_mode(cur, table):
+    '''Return the index mode of table, None if it has no indexes, 'unknown' for surprises.'''
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))
+    names = set(r[0] for r in cur.fetchall())
+    if not names:
+        return None
+    for index, specs in index_modes.items():
+        if names == set('idx_{}_{}'.format(table, suffix) for suffix, cols in specs):
+            return index
+    return 'unknown'
+
+
+def get_db_index_mode(cur):
+    '''Guess the index mode of a database from one of its timeseries tables.'''
+    return get_index_mode(cur, 'ts_param_bridge_points') or 'separate'
+
+
+def set_indexes(cur, table, index='separate', verbose=0):
+    drop_indexes(cur, table, verbose=verbose)
+    create_indexes(cur, table, index=index, verbose=verbose)
+
+
+def drop_indexes(cur, table, verbose=0):
+    '''Drop the indexes of table, and return the sql needed to recreate them.'''
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))
+    indexes = cur.fetchall()
+    for name, sql in indexes:
+        if verbose > 1:
+            print('dropping index', name, file=sys.stderr)
+        cur.execute('DROP INDEX {}'.format(name))
+    return [sql for name, sql in indexes]
+
+
+def restore_indexes(cur, sqls, verbose=0):
+    for sql in sqls:
+        if verbose > 1:
+            print('creating', sql, file=sys.stderr)
+        cur.execute(sql)
 
 
 def configure_wal(cur, wal_size=None, verbose=0):
@@ -129,6 +510,11 @@ def configure_wal(cur, wal_size=None, verbose=0):
         cur.execute('PRAGMA wal_autocheckpoint={}'.format(wal_size))
 
 
+def is_busy(e):
+    '''True for "database is locked" and the like, which are worth retrying, unlike a missing table.'''
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+
 def insert_many_ts(con, tables, verbose=0):
     t = time.time()
     cur = con.cursor()
@@ -136,11 +522,30 @@ def insert_many_ts(con, tables, verbose=0):
     if verbose:
         print('inserting', len(tables), 'items', file=sys.stderr)
 
+    layouts = get_layouts(con)
+    if not con.in_transaction:
+        # so that the savepoints below nest inside the caller's transaction instead of committing
+        cur.execute('BEGIN')
     for param, data in tables.items():
+        table = 'ts_param_' + param
+        layout = layouts.get(table, 'rowid')
+        # a param's points and rollups are written together or not at all
+        cur.execute('SAVEPOINT insert_param')
         try:
-            cur.executemany('INSERT INTO ts_param_{} VALUES(?, ?, ?)'.format(param), data)
+            rows = data
+            if layout in ('points', 'points_strings'):
+                rows = points_rows(con, cur, param, data, intern=(layout == 'points_strings'))
+            cur.executemany(insert_sql(table, layout), rows)
+            insert_rollups(con, cur, param, data, verbose=verbose)
+            cur.execute('RELEASE insert_param')
+            continue
         except sqlite3.OperationalError as e:
             # sqlite3.OperationalError: no such table: ts_param_127_0_0_1
+            if is_busy(e):
+                # not the param's fault, so fail the whole write instead of dropping its rows
+                forget_schema(con)
+                cur.close()
+                raise
             if verbose:
                 print('skipping', repr(e), data, file=sys.stderr)
         except OverflowError as e:
@@ -150,6 +555,12 @@ def insert_many_ts(con, tables, verbose=0):
         except Exception as e:
             if verbose:
                 print('skipping', repr(e), data, file=sys.stderr)
+        if con.in_transaction:
+            # some errors roll back the whole transaction, savepoint and all
+            cur.execute('ROLLBACK TO insert_param')
+            cur.execute('RELEASE insert_param')
+        # maybe a migration changed the schema underneath us, and the cached ids may have been rolled back
+        forget_schema(con)
 
     cur.close()
 
@@ -172,6 +583,8 @@ def insert_many_status(con, status_table, verbose=0):
             cur.executemany('INSERT OR REPLACE INTO bridge_stationStatus VALUES('+questions+')', status_table)
         except sqlite3.OperationalError as e:
             # never seen here
+            if is_busy(e):
+                raise
             if verbose:
                 print('skipping', repr(e), status_table, file=sys.stderr)
         except OverflowError as e:
@@ -185,6 +598,36 @@ def insert_many_status(con, status_table, verbose=0):
         cur.close()
 
 
+def insert_many_event_state(con, rows, verbose=0):
+    '''rows are (station, param, hash, time)'''
+    if not rows:
+        return
+    if verbose:
+        print('inserting', len(rows), 'eventState updates', file=sys.stderr)
+    cur = con.cursor()
+    try:
+        cur.executemany('INSERT OR REPLACE INTO bridge_eventState VALUES (?, ?, ?, ?)', rows)
+    except sqlite3.OperationalError as e:
+        # an old database without the table, see migrations/07-add-event-state.py
+        if is_busy(e):
+            raise
+        if verbose:
+            print('skipping', repr(e), file=sys.stderr)
+    cur.close()
+
+
+def get_event_state(con, verbose=0):
+    cur = con.cursor()
+    try:
+        cur.execute('SELECT station, param, hash FROM bridge_eventState')
+        rows = cur.fetchall()
+    except sqlite3.OperationalError as e:
+        print('not restoring event dedup state:', repr(e), file=sys.stderr)
+        rows = []
+    cur.close()
+    return rows
+
+
 def get_stationStatus(con, verbose=0):
     cur = con.cursor()
     cur.row_factory = sqlite3.Row
@@ -1,6 +1,6 @@
 import sys
 import re
-from collections import defaultdict
+import hashlib
 import json
 
 from . import utils
@@ -15,6 +15,12 @@ telescope_events = []
 def init(verbose=0):
     stations, parameters = utils.read_masterlist()
 
+    # safe to call more than once
+    del splitters[:]
+    splitters_map.clear()
+    del splitters_expanded[:]
+    del telescope_events[:]
+
     for p, v in parameters.items():
         if 'datatype' in v and v['datatype'] in {'CelestialCoordinates', 'AzElCoordinates'}:
             splitters.append(p)
@@ -27,6 +33,7 @@ def init(verbose=0):
             telescope_events.append(p)
     telescope_events.append('telescope_onSource')  # a bool
     # Tsys and tau225 do not generate events
+    build_dispatch()
 
     if verbose:
         print('splitters:', *splitters, file=sys.stderr)
@@ -45,10 +52,16 @@ def splitters_names(param, datatype):
     return (param + suffix[0], param + suffix[1])
 
 
-def transform(flat, verbose=0, dedup_events=False):
-    flat = transform_events(flat, verbose=verbose, dedup_events=dedup_events)
-    flat = transform_splitters(flat, verbose=verbose)
-    return flat
+def transform(batch, verbose=0, dedup_events=False):
+    '''Add events and split coordinates to a utils.Batch, in place. Returns the batch.'''
+    run_pass(batch, verbose=verbose, dedup_events=dedup_events)
+    return batch
+
+
+def transform_status(batch, stationStatus, verbose=0, dedup_events=False):
+    '''transform() and update_stationStatus() in a single pass. Returns the status table.'''
+    tp = run_pass(batch, stationStatus=stationStatus, verbose=verbose, dedup_events=dedup_events)
+    return status_table(stationStatus, tp.changed, verbose=verbose)
 
 
 event_map = {
@@ -63,8 +76,34 @@ event_map = {
 }
 
 
-# used to dedup
-station_latest_event = defaultdict(dict)
+# used to dedup: (station, param) -> value_hash(value). the changes since the
+# last take_event_state() are also kept, so the bridge can save them in the
+# bridge_eventState table in the same transaction as the events
+latest_event = {}
+event_state_changes = {}
+
+
+def value_hash(value):
+    '''A hash of an event value that, unlike hash(), is the same in every process.'''
+    digest = hashlib.blake2b(repr(value).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)  # fits in a sqlite INTEGER
+
+
+def init_event_state(con, verbose=0):
+    '''Restore the event dedup state saved by the bridge.'''
+    latest_event.clear()
+    event_state_changes.clear()
+    for station, param, h in sqlite.get_event_state(con, verbose=verbose):
+        latest_event[(station, param)] = h
+    if verbose:
+        print('restored event dedup state for', len(latest_event), 'station params', file=sys.stderr)
+
+
+def take_event_state():
+    '''Return the (station, param, hash, time) rows that changed since the last call.'''
+    rows = [(station, param, h, t) for (station, param), (h, t) in event_state_changes.items()]
+    event_state_changes.clear()
+    return rows
 
 
 def onsource(value):
@@ -83,62 +122,140 @@ def onsource(value):
     return 'off'
 
 
-def transform_events(flat, verbose=0, dedup_events=False):
-    extras = []
-    for f in flat:
-        station, param, recv_time, value = f
-        if param in telescope_events:
-            if dedup_events and station_latest_event[station].get(param) == value:
-                if verbose:
-                    print('deduping event', station, param, value)
-                continue
-            station_latest_event[station][param] = value
+# param -> handlers, built by init(). a pass looks up each param of a batch
+# once, instead of checking every point against the lists of special params
+dispatch = {}
+status_dispatch = {}
+event_prefix = {}
 
-            if param == 'telescope_epochType':
-                continue
 
-            if param == 'telescope_observingMode':
-                # SMA sends a mode of ' ' whenever it goes off source
-                if value.isspace():
-                    value = ''
-
-            if param == 'telescope_onSource':
-                if onsource(value):
-                    event = 'is on source'
-                else:
-                    event = 'is off source'
-            elif param in event_map:
-                event = event_map[param] + ' ' + value
-            else:
-                p = param.replace('observerMessages_', '')
-                p = param.replace('telescope_', '')
-                event = p + ' is ' + value
-
-            extras.append([station, 'bridge_events', recv_time, station + ' ' + event])
-    if verbose > 1:
-        print('events:', file=sys.stderr)
-        [print(' ', e, file=sys.stderr) for e in extras]
-    return flat + extras
-
-
-def transform_splitters(flat, verbose=0):
-    extras = []
-    for f in flat:
-        station, param, recv_time, value = f
-        if param in splitters:
-            # might have a leading minus, might have a leading plus
-            m = re.match(r'([+\-]?[0-9.]+)([+\-]?[0-9.]+)', value)
-            if not m:
-                print('failed to split', station, param, value, file=sys.stderr)
-                continue
-            first, second = m.groups()
-            expanded = splitters_map[param]
-            extras.append([station, expanded[0], recv_time, first])
-            extras.append([station, expanded[1], recv_time, second])
-    if verbose > 1:
-        print('splits:', file=sys.stderr)
-        [print(' ', e, file=sys.stderr) for e in extras]
-    return flat + extras
+def build_dispatch():
+    dispatch.clear()
+    status_dispatch.clear()
+    event_prefix.clear()
+
+    for p in telescope_events:
+        dispatch.setdefault(p, []).append(transform_event)
+        if p in event_map:
+            event_prefix[p] = event_map[p]
+        else:
+            event_prefix[p] = p.replace('observerMessages_', '').replace('telescope_', '') + ' is'
+    for p in splitters:
+        dispatch.setdefault(p, []).append(transform_split)
+
+    for p in status_map:
+        status_dispatch[p] = status_point
+    for p in recorder_map:
+        status_dispatch[p] = status_recording
+
+
+class Pass:
+    '''The state of one pass over a batch.'''
+    __slots__ = ('batch', 'stationStatus', 'changed', 'events', 'verbose', 'dedup_events')
+
+    def __init__(self, batch, stationStatus=None, verbose=0, dedup_events=False):
+        self.batch = batch
+        self.stationStatus = stationStatus
+        self.changed = set()
+        self.events = []
+        self.verbose = verbose
+        self.dedup_events = dedup_events
+
+
+def run_pass(batch, stationStatus=None, transform=True, verbose=0, dedup_events=False):
+    tp = Pass(batch, stationStatus=stationStatus, verbose=verbose, dedup_events=dedup_events)
+
+    # the handlers add params to the batch, so decide what to visit first
+    if transform:
+        todo = [p for p in batch if p in dispatch or p in status_dispatch]
+    else:
+        todo = [p for p in batch if p in status_dispatch]
+    for param in todo:
+        rows = batch[param]
+        if transform:
+            for handler in dispatch.get(param, ()):
+                handler(tp, param, rows)
+        if stationStatus is not None and param in status_dispatch:
+            status_dispatch[param](tp, param, rows)
+
+    if tp.events:
+        batch['bridge_events'].extend(tp.events)
+        if verbose > 1:
+            print('events:', file=sys.stderr)
+            [print(' ', e, file=sys.stderr) for e in tp.events]
+    return tp
+
+
+def transform_event(tp, param, rows):
+    for recv_time, station, value in rows:
+        key = (station, param)
+        h = value_hash(value)
+        if tp.dedup_events and latest_event.get(key) == h:
+            if tp.verbose:
+                print('deduping event', station, param, value)
+            continue
+        latest_event[key] = h
+        event_state_changes[key] = (h, recv_time)
+
+        if param == 'telescope_epochType':
+            continue
+
+        if param == 'telescope_observingMode':
+            # SMA sends a mode of ' ' whenever it goes off source
+            if value.isspace():
+                value = ''
+
+        if param == 'telescope_onSource':
+            event = 'is ' + onsource(value) + ' source'
+        else:
+            event = event_prefix[param] + ' ' + value
+
+        tp.events.append((recv_time, station, station + ' ' + event))
+
+
+# might have a leading minus, might have a leading plus
+coordinates_re = re.compile(r'([+\-]?[0-9.]+)([+\-]?[0-9.]+)')
+
+
+def split_coordinates(values):
+    '''Split coordinate strings like '+12.5-3.25' into two lists of floats.
+
+    Returns (first, second, failed), where failed lists the indexes of the values
+    that did not parse. first and second hold None at those indexes.'''
+    match = coordinates_re.match
+    first = []
+    second = []
+    failed = []
+    for i, value in enumerate(values):
+        try:
+            a, b = match(value).groups()
+            a, b = float(a), float(b)
+        except (AttributeError, TypeError, ValueError):
+            # no match, not a string, or something like 1.2.3
+            a = b = None
+            failed.append(i)
+        first.append(a)
+        second.append(b)
+    return first, second, failed
+
+
+def transform_split(tp, param, rows):
+    first, second, failed = split_coordinates([r[2] for r in rows])
+    if failed:
+        recv_time, station, value = rows[failed[0]]
+        print('failed to split {} of {} {} points, the first is {} {} {!r}'.format(
+            len(failed), len(rows), param, station, recv_time, value), file=sys.stderr)
+
+    expanded = splitters_map[param]
+    rows0 = tp.batch[expanded[0]]
+    rows1 = tp.batch[expanded[1]]
+    for (recv_time, station, _), a, b in zip(rows, first, second):
+        if a is None:
+            continue
+        rows0.append((recv_time, station, a))
+        rows1.append((recv_time, station, b))
+        if tp.verbose > 1:
+            print('split:', station, param, recv_time, a, b, file=sys.stderr)
 
 
 def init_stationStatus(con, stations, verbose=0):
@@ -202,7 +319,11 @@ recorder_map = {
     'recorder_4_shouldRecord': 4,
 }
 
-extra_status_map = {
+# param -> stationStatus key
+status_map = {
+    'telescope_sourceName': 'source',
+    'telescope_observingMode': 'mode',
+    'telescope_onSource': 'onsource',
     'if_1_systemTemp': 'tsys',
     'weather_tau225': 'tau225',
 }
@@ -230,36 +351,31 @@ def station_change(stationStatus, changed, param, recv_time, station, value):
         stationStatus[station]['time'] = recv_time
 
 
+def status_point(tp, param, rows):
+    key = status_map[param]
+    for recv_time, station, value in rows:
+        if param == 'telescope_sourceName':
+            if value.isspace():  # SMA sends a ' ' when it goes off source
+                value = ''
+        elif param == 'telescope_onSource':
+            value = onsource(value)
+        station_change(tp.stationStatus, tp.changed, key, recv_time, station, value)
+
+
+def status_recording(tp, param, rows):
+    for recv_time, station, value in rows:
+        old_value = tp.stationStatus[station]['recording']
+        value = recording_set_or_unset(old_value, param, value)
+        station_change(tp.stationStatus, tp.changed, 'recording', recv_time, station, value)
+
+
 def update_stationStatus(stationStatus, tables, verbose=0):
-    changed = set()
+    '''The stationStatus part of transform_status(), for tables that are already transformed.'''
+    tp = run_pass(tables, stationStatus=stationStatus, transform=False, verbose=verbose)
+    return status_table(stationStatus, tp.changed, verbose=verbose)
 
-    for point in tables.get('telescope_sourceName', []):
-        recv_time, station, value = point
-        if value.isspace():  # SMA sends a ' ' when it goes off source
-            value = ''
-        station_change(stationStatus, changed, 'source', recv_time, station, value)
-
-    for point in tables.get('telescope_observingMode', []):
-        recv_time, station, value = point
-        station_change(stationStatus, changed, 'mode', recv_time, station, value)
-
-    for point in tables.get('telescope_onSource', []):
-        recv_time, station, value = point
-        value = onsource(value)
-        station_change(stationStatus, changed, 'onsource', recv_time, station, value)
-
-    for param in recorder_map.keys():
-        for point in tables.get(param, []):
-            recv_time, station, value = point
-            old_value = stationStatus[station]['recording']
-            value = recording_set_or_unset(old_value, param, value)
-            station_change(stationStatus, changed, 'recording', recv_time, station, value)
-
-    for param, translation in extra_status_map.items():
-        for point in tables.get(param, []):
-            recv_time, station, value = point
-            station_change(stationStatus, changed, translation, recv_time, station, value)
 
+def status_table(stationStatus, changed, verbose=0):
     status_table = []
     for station in changed:
         if verbose:
@@ -1,9 +1,11 @@
 import getpass
+import os
 import os.path
 import sys
 import grp
 import json
 import time
+import threading
 from collections import defaultdict
 import numpy as np
 
@@ -33,8 +35,134 @@ def write_metadata(metadata, metadir='data', station=None, verbose=0):
         fname = dirname + '/metadata.json'
         if verbose > 1:
             print('writing', fname)
-        with open(fname, 'w') as fd:
-            json.dump(meta, fd, sort_keys=True, indent=4)
+        write_json_atomic(fname, meta, sort_keys=True, indent=4)
+
+
+def write_json_atomic(fname, obj, **kwargs):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(obj, fd, **kwargs)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp, fname)
+
+
+class MetadataStore:
+    '''The per-station metadata.json files, kept in memory.
+
+    Every update is appended to a journal file immediately, and the json files
+    are rewritten (atomically) at most every flush_interval seconds, and by
+    close(). After a crash, the journal is replayed on top of the json files.'''
+
+    def __init__(self, stations, metadir='data', flush_interval=60., verbose=0):
+        self.metadir = metadir
+        self.flush_interval = flush_interval
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.metadata = read_metadata(stations, metadir=metadir, verbose=verbose)
+        self.dirty = set()
+
+        os.makedirs(metadir, exist_ok=True)
+        self.journal_file = metadir + '/metadata.journal'
+        self.replay()
+        self.journal = open(self.journal_file, 'a')
+        self.last_flush = time.time()
+
+    def replay(self):
+        if not os.path.exists(self.journal_file):
+            return
+        count = 0
+        with open(self.journal_file) as fd:
+            for line in fd:
+                try:
+                    station, param, kwargs = json.loads(line)
+                except ValueError:
+                    # a torn last line from a crash
+                    continue
+                self.apply(station, param, kwargs)
+                count += 1
+        if self.verbose:
+            print('replayed', count, 'metadata journal entries from', self.journal_file)
+        self.flush_files()
+        os.remove(self.journal_file)
+
+    def apply(self, station, param, kwargs):
+        meta = self.metadata.setdefault(station, {}).setdefault(param, {})
+        meta.update(kwargs)
+        self.dirty.add(station)
+
+    def get(self, station, param, key, default=None):
+        with self.lock:
+            return self.metadata.get(station, {}).get(param, {}).get(key, default)
+
+    def update(self, station, param, **kwargs):
+        kwargs = dict((k, v) for k, v in kwargs.items() if v is not None)
+        with self.lock:
+            self.apply(station, param, kwargs)
+            self.journal.write(json.dumps([station, param, kwargs]) + '\n')
+            self.journal.flush()
+            if time.time() - self.last_flush > self.flush_interval:
+                self.flush()
+
+    def flush_files(self):
+        for station in sorted(self.dirty):
+            write_metadata(self.metadata, metadir=self.metadir, station=station, verbose=self.verbose)
+        self.dirty = set()
+
+    def flush(self):
+        # caller holds the lock
+        self.flush_files()
+        self.journal.truncate(0)
+        self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            self.flush_files()
+            self.journal.close()
+            os.remove(self.journal_file)
+
+
+def csv_last_time(fname):
+    '''Return the time of the last line of a history csv file, or None.'''
+    try:
+        with open(fname, 'rb') as fd:
+            fd.seek(0, os.SEEK_END)
+            fd.seek(max(0, fd.tell() - 4096))
+            lines = fd.read().splitlines()
+    except FileNotFoundError:
+        return None
+    for line in reversed(lines):
+        try:
+            return int(line.split(b',', 1)[0])
+        except ValueError:
+            continue
+    return None
+
+
+def csv_repair_tail(fname):
+    '''Cut off a torn last line left by a crash in csv_append, and return csv_last_time.'''
+    try:
+        with open(fname, 'rb+') as fd:
+            size = fd.seek(0, os.SEEK_END)
+            fd.seek(max(0, size - 4096))
+            tail = fd.read()
+            if tail and not tail.endswith(b'\n'):
+                keep = size - len(tail) + tail.rfind(b'\n') + 1
+                if keep == 0 and size > len(tail):
+                    raise ValueError('{} ends with a line longer than 4096 bytes'.format(fname))
+                print('removing a torn last line from', fname, file=sys.stderr)
+                fd.truncate(keep)
+    except FileNotFoundError:
+        return None
+    return csv_last_time(fname)
+
+
+def csv_append(fname, lines):
+    '''Append lines to fname and fsync. A crash can leave a torn last line, which csv_repair_tail removes.'''
+    with open(fname, 'a') as fd:
+        fd.writelines(lines)
+        fd.flush()
+        os.fsync(fd.fileno())
 
 
 def read_masterlist(fname='masterlist.json'):
@@ -97,8 +225,43 @@ def comment_on_masterlist(stations, parameters, verbose=0):
     print(' ', 'len params private', len([x for x in parameters.items() if 'cadence' in x[1] and 'private' in x[1]['cadence']]))
 
 
-def flatten(snap, bridge_lag=None, add_points=False, to_int=True, verbose=0):
-    ret = []
+class Batch(defaultdict):
+    '''Points grouped by param, each a list of (time, station, value) rows.
+
+    These are the rows the ts_param_ tables take, so insert_many_ts hands them
+    straight to executemany. flatten() fills one of these, and the transformer
+    adds to it in place, instead of each stage copying a flat list of
+    [station, param, time, value] records.'''
+
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(list)
+
+    def add(self, station, param, recv_time, value):
+        self[param].append((recv_time, station, value))
+
+    def extend(self, flat):
+        '''Add flat [station, param, time, value] records.'''
+        for station, param, recv_time, value in flat:
+            self[param].append((recv_time, station, value))
+
+    def merge(self, other):
+        for param, rows in other.items():
+            self[param].extend(rows)
+
+    def count(self):
+        return sum(len(rows) for rows in self.values())
+
+    def records(self):
+        '''Flat [station, param, time, value] records, for code that still wants them.'''
+        for param, rows in self.items():
+            for recv_time, station, value in rows:
+                yield [station, param, recv_time, value]
+
+
+def snapshot_records(snap, to_int=True):
+    '''Yield flat [station, param, time, value] records from a snapshot dict.'''
     for s, v in snap.items():
         if s == 'vexfiles':
             continue
@@ -116,37 +279,53 @@ def flatten(snap, bridge_lag=None, add_points=False, to_int=True, verbose=0):
                 recvTime = v2[0]
                 if to_int:
                     recvTime = int(recvTime)
-                value = v2[1]
-                line = [s, d, recvTime, value]
-                ret.append(line)
+                yield [s, d, recvTime, v2[1]]
+
+
+def flatten(snap, bridge_lag=None, add_points=False, to_int=True, batch=None, verbose=0):
+    '''Turn a snapshot dict, or flat records like decode.iter_snapshot yields, into a Batch.
+
+    With batch, add to that Batch instead of a new one.'''
+    if batch is None:
+        batch = Batch()
+    if isinstance(snap, dict):
+        snap = snapshot_records(snap, to_int=to_int)
+
+    points = 0
+    latest_point = None
+    station_points = defaultdict(int)
+    for station, param, recv_time, value in snap:
+        batch[param].append((recv_time, station, value))
+        points += 1
+        station_points[station] += 1
+        if latest_point is None or recv_time > latest_point:
+            latest_point = recv_time
+
     if add_points:
-        points = len(ret)
-        latest_point = int(time.time()) if len(ret) == 0 else max([r[2] for r in ret])
-        total_lag = time.time() - latest_point  # float
         now = int(time.time())
-        station_points = defaultdict(int)
-        for r in ret:
-            station_points[r[0]] += 1
+        if latest_point is None:
+            latest_point = now
+        total_lag = time.time() - latest_point  # float
+        rows = batch['bridge_points']
         for s, value in station_points.items():
-            if value > 0:
-                ret.append([s, 'bridge_points', int(time.time()), value])
-        ret.append(['bridge', 'bridge_points', now, points])  # do this last so these are not counted for station 'bridge'
-        ret.append(['bridge', 'bridge_totalLag', now, total_lag])
+            rows.append((now, s, value))
+        rows.append((now, 'bridge', points))
+        batch['bridge_totalLag'].append((now, 'bridge', total_lag))
         if bridge_lag:
-            ret.append(['bridge', 'bridge_bridgeLag', now, bridge_lag])
+            batch['bridge_bridgeLag'].append((now, 'bridge', bridge_lag))
 
     if verbose > 1:
-        [print(r) for r in ret]
-    return ret
+        [print(r) for r in batch.records()]
+    return batch
 
 
 def flat_to_tables(flat):
     # flat record: station, param, time, value
     # sql tables are named param and the rows are time, station, value
-    tables = defaultdict(list)
-    for f in flat:
-        station, param, recv_time, value = f
-        tables[param].append((recv_time, station, value),)
+    if isinstance(flat, Batch):
+        return flat
+    tables = Batch()
+    tables.extend(flat)
     return tables
 
 